@@ -25,29 +25,39 @@ SOFTWARE.
 import ast
 import gc
 import glob
+import hashlib
+import os
+import shutil
+import tempfile
 import timeit
-from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas as gpd
 import osmnx as ox
 import pandana as pdna
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import pylab as pl
 import rasterio
-import requests
 import seaborn as sns
 import skbio.diversity as diversity
 import statsmodels.api as sm
+from Download import DownloadManager, OpenStreetMap, ResponseCache
+from GeoPackage import FID, Layers
 from PIL import Image
 from Statistics.basic_stats import shannon_div
 from fiona import listlayers
 from graph_tool.all import *
 from matplotlib.colors import ListedColormap
+from matplotlib.path import Path as MplPath
 from pylab import *
 from rasterio import features
 from rtree import index
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
+from scipy import sparse
 from shapely.affinity import translate, scale
 from shapely.geometry import *
 from shapely.ops import nearest_points
@@ -56,18 +66,110 @@ from sklearn.mixture import GaussianMixture, BayesianGaussianMixture
 from sklearn.cluster import KMeans
 from skspatial import interp2d
 
-def download_file(url, filename=None):
+def download_file(url, filename=None, sha256=None):
     if filename is None: local_filename = url.split('/')[-1]
     else: local_filename = filename
-    # NOTE the stream=True parameter below
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-                    # f.flush()
-    return local_filename
+    # Resumes interrupted transfers and skips files that did not change since the last download
+    return DownloadManager().download(url, local_filename, sha256=sha256)
+
+def unify_types(types):
+    """
+    Arrow type that holds the values of all types inferred for a column
+    """
+    types = [t for t in types if not pa.types.is_null(t)]
+    if len(types) == 0: return pa.string()
+    if all(t == types[0] for t in types): return types[0]
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types): return pa.float64()
+    return pa.string()
+
+def column_types(batch):
+    """
+    Narrowest of int64, float64 and string types that holds every value of each column of a record batch of strings
+    """
+    types = {}
+    for name, column in zip(batch.schema.names, batch.columns):
+        if column.null_count == len(column):
+            types[name] = pa.null()
+            continue
+        for kind in [pa.int64(), pa.float64(), pa.string()]:
+            try:
+                pc.cast(column, kind)
+                types[name] = kind
+                break
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError): continue
+    return types
+
+# File that marks directories written by ingest_csv, which are the only ones it replaces
+DATASET_MARKER = '_ingested_csv'
+
+def ingest_csv(path, out=None, pattern='*.csv', workers=4, block_size=2**24):
+    """
+    Stream CSV files of a folder into a Parquet dataset partitioned by source file, reading files in parallel with
+    column types unified across files. Files are read twice by blocks, first as strings to infer the type of each
+    column from all of its values, then to convert and write them, so memory use is bounded by the number of workers
+    regardless of the size of the folder.
+
+    :param path: (str) Folder of the CSV files
+    :param out: (str) Directory of the dataset, 'merged.parquet' within the folder if None. An existing directory is
+    only replaced if it was written by this function.
+    :param pattern: (str) Pattern of the CSV file names
+    :param workers: (int) Number of files read at the same time
+    :param block_size: (int) Bytes read at a time from each file
+    :return: (pyarrow.dataset.Dataset) Lazily evaluated dataset, ex: dataset.to_table(columns=[...]).to_pandas()
+    """
+    start_time = timeit.default_timer()
+    if out is None: out = os.path.join(path, 'merged.parquet')
+    if os.path.exists(out) and not os.path.exists(os.path.join(out, DATASET_MARKER)):
+        raise FileExistsError(f"{out} exists and is not a dataset ingested from CSVs, it is not replaced")
+
+    # The dataset is written to a new staging directory next to it and moved into place once complete
+    parent = os.path.dirname(os.path.abspath(out))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f".{os.path.basename(os.path.abspath(out))}.", dir=parent)
+    files = sorted(f for f in glob.glob(os.path.join(path, pattern)) if os.path.isfile(f))
+    read_options = pa_csv.ReadOptions(block_size=block_size)
+
+    def strings(file):
+        with pa_csv.open_csv(file, read_options=read_options) as reader: names = reader.schema.names
+        return pa_csv.ConvertOptions(column_types={name: pa.string() for name in names}, strings_can_be_null=True)
+
+    # Infer types from every block of every file read as strings and unify them
+    def infer(file):
+        types = {}
+        with pa_csv.open_csv(file, read_options=read_options, convert_options=strings(file)) as reader:
+            for batch in reader:
+                for name, kind in column_types(batch).items(): types.setdefault(name, []).append(kind)
+            names = reader.schema.names
+        return {name: unify_types(types.get(name, [])) for name in names}
+    with ThreadPoolExecutor(max_workers=workers) as pool: file_types = list(pool.map(infer, files))
+    names = list(dict.fromkeys(name for types in file_types for name in types.keys()))
+    schema = pa.schema([(name, unify_types([types[name] for types in file_types if name in types]))
+                        for name in names])
+
+    def write(file, types):
+        source = os.path.splitext(os.path.basename(file))[0]
+        os.makedirs(os.path.join(staging, f"source={source}"), exist_ok=True)
+        rows = 0
+        with pa_csv.open_csv(file, read_options=read_options, convert_options=strings(file)) as reader, \
+                pq.ParquetWriter(os.path.join(staging, f"source={source}", 'part-0.parquet'), schema) as writer:
+            for batch in reader:
+                arrays = [pc.cast(batch.column(name), schema.field(name).type) if name in types
+                          else pa.nulls(batch.num_rows, schema.field(name).type) for name in names]
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                rows += batch.num_rows
+        return rows
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool: rows = sum(pool.map(write, files, file_types))
+        with open(os.path.join(staging, DATASET_MARKER), 'w') as file: file.write('\n'.join(files))
+    except:
+        shutil.rmtree(staging)
+        raise
+    if os.path.exists(out): shutil.rmtree(out)
+    os.replace(staging, out)
+    elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+    print(f"> {rows} rows of {len(files)} CSVs ingested to {out} in {elapsed} minutes")
+    return ds.dataset(out, format='parquet', partitioning='hive')
 
 def filter_features(df, y_features, x_features=None, pval_threshold=0.05, corr_threshold=0.3):
         """
@@ -160,6 +262,182 @@ def filter_features(df, y_features, x_features=None, pval_threshold=0.05, corr_t
 
         return ftrs
 
+def query_bulk(tree_gdf, geometry, predicate=None):
+    """
+    Query the spatial index of tree_gdf with an array of geometries, returns positions of input and tree geometries
+    """
+    try: return tree_gdf.sindex.query_bulk(geometry, predicate=predicate)
+    except AttributeError: return tree_gdf.sindex.query(geometry, predicate=predicate)
+
+def radial_membership(samples, features, max_radius):
+    """
+    Relates features to the centroids of samples within the largest radius of analysis and records their distances,
+    so that membership of every smaller (concentric) radius can be derived from distance bins
+
+    :param samples: (GeoDataFrame) Sample features whose centroids are the center of the radii
+    :param features: (GeoDataFrame) Features to be related to the samples
+    :param max_radius: (float) Largest radius of analysis
+    :return: DataFrame with the position of the sample, the position of the feature and the distance between their
+    centroids
+    """
+
+    centroids = gpd.GeoSeries(list(samples.geometry.centroid), crs=samples.crs)
+    ftr_gdf = gpd.GeoDataFrame(geometry=list(features.geometry.centroid), crs=samples.crs)
+
+    # Single spatial query at the largest radius, with a buffer padded beyond the polygon approximation of the circle
+    # where the index does not support distance queries
+    try: sample_idx, feature_idx = ftr_gdf.sindex.query(centroids, predicate='dwithin', distance=max_radius)
+    except (TypeError, ValueError, NotImplementedError):
+        sample_idx, feature_idx = query_bulk(ftr_gdf, centroids.buffer(max_radius * 1.01), predicate='intersects')
+    distance = gpd.GeoSeries(ftr_gdf.geometry.values[feature_idx]).distance(
+        gpd.GeoSeries(centroids.values[sample_idx]), align=False).values
+
+    membership = pd.DataFrame({'sample': sample_idx, 'feature': feature_idx, 'distance': distance})
+    return membership.loc[membership['distance'] <= max_radius].reset_index(drop=True)
+
+def radial_sums(membership, values, radii, n_samples):
+    """
+    Sums feature values around each sample cumulatively over distance bins, one column for each radius
+
+    :param membership: (DataFrame) Output from radial_membership
+    :param values: (DataFrame) Numeric values of the features, ordered by feature position
+    :param radii: (list) Radii of analysis
+    :param n_samples: (int) Number of samples
+    :return: dict of DataFrames (samples x radii) for each column of values
+    """
+
+    radii = sorted(radii)
+    df = membership.copy()
+    df['bin'] = np.searchsorted(radii, df['distance'].values, side='left')
+    for col in values.columns:
+        df[col] = values[col].values[df['feature'].values]
+
+    sums = {}
+    for col in values.columns:
+        table = df.groupby(['sample', 'bin'])[col].sum().unstack('bin', fill_value=0)
+        table = table.reindex(index=range(n_samples), columns=range(len(radii)), fill_value=0).cumsum(axis=1)
+        table.columns = radii
+        sums[col] = table
+    return sums
+
+
+def fft_disc_sums(grids, radii, cell_size):
+    """
+    Sum values of raster grids within discs of every radius around each cell using FFT convolution
+
+    :param grids: (list) 2D arrays with the same shape
+    :param radii: (list) Radii of the discs in map units
+    :param cell_size: (float) Size of the grid cells in map units
+    :return: dict of lists of 2D arrays (with the shape of the grids) for each radius
+    """
+
+    n_x, n_y = grids[0].shape
+    r_max = int(math.ceil(max(radii) / cell_size))
+    shape = (n_x + 2 * r_max, n_y + 2 * r_max)
+    spectra = [np.fft.rfft2(grid, shape) for grid in grids]
+
+    sums = {}
+    for radius in radii:
+        r = int(math.ceil(radius / cell_size))
+        offsets = np.arange(-r, r + 1) * cell_size
+        kernel = ((offsets[:, None] ** 2 + offsets[None, :] ** 2) <= radius ** 2).astype(float)
+        k_spectrum = np.fft.rfft2(kernel, shape)
+        sums[radius] = [np.fft.irfft2(spectrum * k_spectrum, shape)[r:r + n_x, r:r + n_y] for spectrum in spectra]
+    return sums
+
+
+def geometry_digest(*gdfs):
+    """
+    Digest of the geometries and CRS of GeoDataFrames
+    """
+    sha = hashlib.sha256()
+    for gdf in gdfs:
+        sha.update(str(gdf.crs).encode('utf-8'))
+        for geom in gdf.geometry: sha.update(b'' if geom is None else geom.wkb)
+    return sha.hexdigest()
+
+
+def overlap_matrix(source, target, directory=None):
+    """
+    Sparse matrix with the share of the area of each target polygon (rows) covered by each source polygon (columns),
+    computed from one bulk spatial query. Matrices are cached as .npz files named after the digest of both layers, so
+    they are reused while geometries do not change.
+
+    :param source: (GeoDataFrame) Polygons values are aggregated from
+    :param target: (GeoDataFrame) Polygons values are aggregated to
+    :param directory: (str) Directory of cached matrices, not cached if None
+    :return: scipy.sparse.csr_matrix with shape (len(target), len(source))
+    """
+    digest = geometry_digest(source, target)
+    path = None if directory is None else f"{directory}/overlap_{digest[:16]}.npz"
+    if (path is not None) and os.path.exists(path):
+        try:
+            npz = np.load(path)
+            if str(npz['digest']) == digest:
+                return sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+        except (OSError, KeyError, ValueError): print(f"!!! Overlap matrix cache {path} could not be read !!!")
+
+    start_time = timeit.default_timer()
+    target_i, source_i = query_bulk(source, target.geometry.values, predicate='intersects')
+    left = gpd.GeoSeries(target.geometry.values[target_i], crs=target.crs)
+    right = gpd.GeoSeries(source.geometry.values[source_i], crs=target.crs)
+    share = left.intersection(right).area.values / left.area.values
+    keep = share > 0
+    matrix = sparse.csr_matrix((share[keep], (target_i[keep], source_i[keep])), shape=(len(target), len(source)))
+
+    if path is not None:
+        if not os.path.exists(directory): os.makedirs(directory)
+        np.savez(path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=matrix.shape,
+                 digest=digest)
+    elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+    print(f"> Overlap matrix of {len(source)} by {len(target)} polygons computed in {elapsed} minutes")
+    return matrix
+
+
+def area_weighted(matrix, df):
+    """
+    Area-weighted mean of every column of df (rows ordered as the source of the overlap matrix) within each target,
+    as one sparse matrix product. Missing values are left out of the weights.
+
+    :return: DataFrame with one row per target
+    """
+    values = df.values.astype(float)
+    valid = np.isfinite(values)
+    weighted = matrix @ np.where(valid, values, 0)
+    weights = matrix @ valid.astype(float)
+    mean = np.divide(weighted, weights, out=np.full(weighted.shape, np.nan), where=weights > 0)
+    return pd.DataFrame(mean, columns=df.columns)
+
+
+# Characteristics (member ids) of the census profile of dissemination areas and the columns they are joined to, by
+# census year of the profile format (ids of the same characteristic differ between years). Columns are named after the
+# characteristics of the profile, as read by the indicators (ex: network_layers of _0_Variables)
+CENSUS_CHARACTERISTICS = {
+    2016: {
+        1: 'population, 2016',
+        2: 'population, 2011',
+        4: 'total private dwellings, 2016',
+        5: 'n_dwellings',
+        6: 'population density per square kilometre, 2016',
+        7: 'land area in square kilometres, 2016',
+    },
+    2021: {
+        1: 'population, 2021',
+        2: 'population, 2016',
+        4: 'total private dwellings, 2021',
+        5: 'n_dwellings',
+        6: 'population density per square kilometre, 2021',
+        7: 'land area in square kilometres, 2021',
+    },
+}
+
+
+def census_codes(series):
+    """
+    Geographic codes (i.e. DAUID) as strings, without the decimals of codes read as floats
+    """
+    return series.astype(str).str.strip().str.replace(r'\.0+$', '', regex=True)
+
 
 class GeoBoundary:
     def __init__(self, municipality='City, State', crs=26910,
@@ -175,91 +453,151 @@ class GeoBoundary:
         self.city_name = str(self.municipality).split(',')[0]
         self.crs = crs
 
-        try:
-            self.boundary = gpd.read_file(self.gpkg, layer='land_municipal_boundary', driver='GPKG')
-            self.bbox = self.boundary.total_bounds
-            print("> land_municipal_boundary layer found")
-        except: print("> land_municipal_boundary layer not found")
+        # Layers are read from the GeoPackage on first access
+        self._layers = None
+        self._assigned = {}
 
-        try:
-            self.nodes = gpd.read_file(self.gpkg, layer='network_nodes')
-            self.links = gpd.read_file(self.gpkg, layer='network_links')
-            print("> network_nodes & _links layers found")
-        except: print("> network_nodes &| _links layer(s) not found")
+        # Node clusters of the street network indicators, keyed by tolerance and digest of the nodes they were built on,
+        # the digest is kept with the nodes frame it was computed from
+        self._node_clusters = (None, None)
+        self._node_digest = (None, None)
+
+        # Layers are snapshot before indicators are written, in a sidecar archive or inside the GeoPackage, keeping the
+        # most recent snapshots of each layer and removing the ones older than days (if not None)
+        self.snapshots = {'sidecar': True, 'keep': 3, 'days': None}
 
         print(f"Class {self.city_name} created @ {datetime.datetime.now()}, crs {self.crs}")
 
+    @property
+    def layers(self):
+        """
+        Cached access to layers of the GeoPackage, ex: self.layers['network_nodes']
+        """
+        if (self._layers is None) or (self._layers.gpkg != self.gpkg): self._layers = Layers(self.gpkg)
+        return self._layers
+
+    def _layer_attribute(self, name, layer):
+        if name in self._assigned: return self._assigned[name]
+        # The cached layer is shared, callers that modify the frame in place copy it first
+        try: return self.layers.get(layer, copy=False)
+        except:
+            print(f"> {layer} layer not found")
+            return None
+
+    def _assign_attribute(self, name, value):
+        if value is None: self._assigned.pop(name, None)
+        else: self._assigned[name] = value
+
+    @property
+    def boundary(self):
+        return self._layer_attribute('boundary', 'land_municipal_boundary')
+
+    @boundary.setter
+    def boundary(self, value):
+        self._assign_attribute('boundary', value)
+
+    @property
+    def bbox(self):
+        if self.boundary is None: return None
+        return self.boundary.total_bounds
+
+    @property
+    def nodes(self):
+        return self._layer_attribute('nodes', 'network_nodes')
+
+    @nodes.setter
+    def nodes(self, value):
+        self._assign_attribute('nodes', value)
+        self._node_clusters = (None, None)
+        self._node_digest = (None, None)
+
+    @property
+    def links(self):
+        return self._layer_attribute('links', 'network_links')
+
+    @links.setter
+    def links(self, value):
+        self._assign_attribute('links', value)
+
     # Download and pre process data
-    def update_databases(self, bound=True, net=True, census=False, icbc=False):
+    def update_databases(self, bound=True, net=True, census=False, icbc=False, offline=False):
+        # OpenStreetMaps responses are cached, offline replays them without downloading
+        osm = OpenStreetMap(ResponseCache(f"{self.directory}Cache", offline=offline))
+
         # Download administrative boundary from OpenStreetMaps
         if bound:
             print(f"> Downloading {self.city_name}'s administrative boundary from OpenStreetMaps")
-            self.boundary = ox.gdf_from_place(self.municipality)
-            self.boundary.to_file(self.gpkg, layer='land_municipal_boundary', driver='GPKG')
-            self.boundary = gpd.read_file(self.gpkg, layer='land_municipal_boundary')
-            self.boundary.to_crs(epsg=self.crs, inplace=True)
-            self.bbox = self.boundary.total_bounds
+            self.layers['land_municipal_boundary'] = osm.boundary(self.municipality)
+            self.boundary = self.layers['land_municipal_boundary'].to_crs(epsg=self.crs)
             s_index = self.boundary.sindex
 
         # Download street networks from OpenStreetMaps
         if net:
             print(f"> Downloading {self.city_name}'s street network from OpenStreetMaps")
 
-            def save_and_open(ox_g, name=''):
-                ox.save_graph_shapefile(ox_g, 'osm', self.directory)
-                edges = gpd.read_file(f'{self.directory}osm/edges/edges.shp')
-                nodes = gpd.read_file(f'{self.directory}osm/nodes/nodes.shp')
+            # Layers are written in one transaction when the download and filtering are finished
+            writer = self.layers.writer()
 
-                edges.crs = 4326
-                edges.to_crs(epsg=self.crs, inplace=True)
-                edges.to_file(self.gpkg, layer=f"{name}_links", driver='GPKG')
-                nodes.crs = 4326
-                nodes.to_crs(epsg=self.crs, inplace=True)
-                nodes.to_file(self.gpkg, layer=f'{name}_nodes', driver='GPKG')
+            def graph_to_layers(ox_g):
+                # Convert the graph in memory, with the column names and flat values of the former shapefile export
+                nodes, edges = ox.graph_to_gdfs(ox_g)
+                if 'osmid' not in nodes.columns: nodes = nodes.reset_index()
+                if 'u' not in edges.columns: edges = edges.reset_index()
+                edges = edges.rename(columns={'u': 'from', 'v': 'to'})
 
+                for gdf in [nodes, edges]:
+                    if gdf.crs is None: gdf.crs = 4326
+                    gdf.to_crs(epsg=self.crs, inplace=True)
                 return nodes, edges
 
-            network = ox.graph_from_place(self.municipality)
-            st_nodes, st_edges = save_and_open(network, 'network')
-            cycleway = ox.graph_from_place(self.municipality, infrastructure='way["cycleway"]')
-            c_nodes, c_edges = save_and_open(cycleway, 'network_cycle')
+            def flatten(gdf):
+                # Lists of OSM tags merged on simplified edges are stored as text
+                for col in gdf.columns:
+                    if (col != 'geometry') and (gdf[col].dtype == object):
+                        gdf[col] = [str(v) if isinstance(v, (list, set, dict)) else v for v in gdf[col]]
+                return gdf
 
-            # Simplify links
-            s_tol = 15
-            s_links = st_edges
-            s_links.geometry = st_edges.simplify(s_tol)
+            # Street network and cycleways are built from one Overpass query
+            network, cycleway = osm.networks(osm.boundary(self.municipality).unary_union)
+            st_nodes, st_edges = graph_to_layers(network)
+            c_nodes, c_edges = graph_to_layers(cycleway)
 
             print("Filtering networks from OpenStreetMap")
 
-            # Filter Open Street Map Networks into Walking, Cycling and Driving
-            def filter_highway(l):
-                mask = []
-                for j in st_edges.highway:
-                    mh = []
-                    for i in l:
-                        if (i in j) | (i == j): mh.append(True)
-                    if len(mh) > 0:
-                        mask.append(True)
-                    else:
-                        mask.append(False)
-                return st_edges.loc[mask]
-
+            # Classify Open Street Map links into Walking, Cycling and Driving in one pass over the exploded highway
+            # tags, a link belongs to a mode if any of its tags contains one of the mode's highway types
             walking = ['bridleway', 'corridor', 'footway', 'living_street', 'path', 'pedestrian', 'residential',
                        'primary', 'road', 'secondary', 'service', 'steps', 'tertiary', 'track', 'trunk', 'unclassified']
             cycling = ['cycleway']
             driving = ['corridor', 'living_street', 'motorway', 'primary', 'primary_link', 'residential', 'road',
                        'secondary', 'secondary_link', 'service', 'tertiary', 'tertiary_link', 'trunk', 'trunk_link',
                        'unclassified']
+            tags = st_edges['highway'].apply(lambda h: list(h) if isinstance(h, (list, set)) else [h]).explode()
+            tags = tags.dropna().astype(str)
+            for mode, types in {'walk': walking, 'cycle': cycling, 'drive': driving}.items():
+                matches = {tag for tag in tags.unique() if any(t in tag for t in types)}
+                st_edges[mode] = tags.isin(matches).groupby(level=0).any().reindex(st_edges.index, fill_value=False)
+
+            st_edges, c_edges = flatten(st_edges), flatten(c_edges)
+            writer['network_links'] = st_edges
+            writer['network_nodes'] = flatten(st_nodes)
+            writer['network_cycle_links'] = c_edges
+            writer['network_cycle_nodes'] = flatten(c_nodes)
 
-            walking_net = filter_highway(walking)
-            cycling_net = pd.concat([filter_highway(cycling), c_edges]).reset_index().drop('index', axis=1)
+            # Simplify links
+            s_tol = 15
+            s_links = st_edges
+            s_links.geometry = st_edges.simplify(s_tol)
+
+            walking_net = st_edges.loc[st_edges['walk']]
+            cycling_net = pd.concat([st_edges.loc[st_edges['cycle']], c_edges]).reset_index().drop('index', axis=1)
             cycling_net = cycling_net.drop_duplicates(subset=['geometry'])
             cycling_net.loc[:, 'cycle_length'] = cycling_net.geometry.length
-            driving_net = filter_highway(driving)
+            driving_net = st_edges.loc[st_edges['drive']]
 
-            walking_net.to_file(self.gpkg, layer='network_walk')
-            cycling_net.to_file(self.gpkg, layer='network_cycle')
-            driving_net.to_file(self.gpkg, layer='network_drive')
+            writer['network_walk'] = walking_net
+            writer['network_cycle'] = cycling_net
+            writer['network_drive'] = driving_net
 
             sbb = False
             if sbb:
@@ -279,25 +617,18 @@ class GeoBoundary:
 
                 s_links['geometry'] = lns
 
-            s_links.to_file(self.gpkg, layer='network_links_simplified')
+            writer['network_links_simplified'] = s_links
+            writer.commit()
             print("Street network from OpenStreetMap updated")
 
-    def merge_csv(self, path):
-        os.chdir(path)
-        file_out = "merged.csv"
-        if os.path.exists(file_out):
-            os.remove(file_out)
-        file_pattern = ".csv"
-        list_of_files = [file for file in glob.glob('*'+file_pattern)]
-        print(list_of_files)
-        # Consolidate all CSV files into one object
-        result_obj = pd.concat([pd.read_csv(file) for file in list_of_files])
-        # Convert the above object into a csv file and export
-        result_obj.to_csv(file_out, index=False, encoding="utf-8")
-        df = pd.read_csv("merged.csv")
-        full_path = os.path.realpath(__file__)
-        path, filename = os.path.split(full_path)
-        os.chdir(path)
+    def merge_csv(self, path, out=None):
+        """
+        Merge CSV files of a folder into a Parquet dataset (see ingest_csv), use ingest_csv to query the dataset lazily
+
+        :return: DataFrame with the rows of every CSV file
+        """
+        dataset = ingest_csv(path, out=out)
+        df = dataset.to_table(columns=[name for name in dataset.schema.names if name != 'source']).to_pandas()
         print('CSVs successfully merged')
         return df
 
@@ -317,7 +648,7 @@ class GeoBoundary:
         if run:
             start_time = timeit.default_timer()
 
-            nodes_gdf = gpd.read_file(self.gpkg, layer='network_nodes')
+            nodes_gdf = self.layers.read('network_nodes', fids=True)
             nodes_gdf.crs = self.crs
             nodes_gdf_4326 = nodes_gdf.to_crs(epsg=4326)
 
@@ -332,7 +663,7 @@ class GeoBoundary:
                 elevations.append(self.elevation(f'{self.directory}/Topography/{filename}', lon, lat))
 
             nodes_gdf['elevation'] = elevations
-            nodes_gdf.to_file(self.gpkg, layer='network_nodes')
+            self.layers.upsert('network_nodes', nodes_gdf, ['elevation'])
 
             elapsed = round((timeit.default_timer() - start_time) / 60, 1)
             return print(f"Elevation processed in {elapsed} minutes")
@@ -340,7 +671,7 @@ class GeoBoundary:
     # Network analysis
     def gravity(self):
         # WIP
-        gdf = gpd.read_file(self.gpkg, layer='land_dissemination_area')
+        gdf = self.layers['land_dissemination_area']
         flows = {'origin': [], 'destination': [], 'flow': []}
         for oid in gdf.DAUID:
             for did in gdf.DAUID:
@@ -358,7 +689,7 @@ class GeoBoundary:
         if run:
             rf = 3
 
-            links = gpd.read_file(self.gpkg, layer=layer)
+            links = self.layers[layer]
             start_time = timeit.default_timer()
             print(f"Processing centrality measures for {self.municipality} with {len(links)} links from OSM")
 
@@ -381,7 +712,7 @@ class GeoBoundary:
             if osm:
                 # Create topological graph and add vertices
                 osm_g = Graph(directed=False)
-                nodes = gpd.read_file(self.gpkg, layer='network_nodes')
+                nodes = self.layers.read('network_nodes', fids=True)
                 links = calculate_azimuth(links)
 
                 for i in list(nodes.index):
@@ -657,7 +988,10 @@ class GeoBoundary:
                 nodes['node_n_betweenness'] = np.log(nodes['node_betweenness'])
                 nodes['node_n_betweenness'] = clean(nodes['node_n_betweenness'])
                 nodes['node_closeness'] = clean(nodes['node_closeness'])
-                nodes.to_file(self.gpkg, layer='network_nodes')
+                # On the dual graph nodes are the exploded links, which are exported to network_simplified below
+                if not dual:
+                    self.layers.upsert('network_nodes', nodes, ['node_closeness', 'node_betweenness',
+                                                                'node_n_betweenness'])
 
                 # Assign betweenness to links
                 links['link_betweenness'] = btw[1].get_array()
@@ -737,7 +1071,7 @@ class GeoBoundary:
             if keep is None: keep = ['geometry']
 
             # Read and reproject sample GeoDataFrame
-            sample_gdf = gpd.read_file(self.gpkg, layer=sample_layer)
+            sample_gdf = self.layers[sample_layer]
             sample_gdf = sample_gdf.to_crs(epsg=self.crs)
             sample_gdf.columns = [col_name.lower() for col_name in sample_gdf.columns]
 
@@ -745,8 +1079,8 @@ class GeoBoundary:
             print(f'\n> Network analysis for {orig_n} geometries at {service_areas} buffer radius in {self.city_name}')
 
             # Load data
-            nodes = self.nodes
-            edges = self.links
+            nodes = self.nodes.copy()
+            edges = self.links.copy()
             print(nodes.head(3))
             print(edges.head(3))
             nodes.index = list(nodes['osmid'].astype(int))
@@ -767,6 +1101,10 @@ class GeoBoundary:
                         print("!!! Column filter has failed !!!")
             sample_gdf = sample_gdf.reset_index(drop=True)
 
+            # Aggregated features farther than the largest radius from every sample cannot be reached on the network
+            extent = gpd.GeoDataFrame(geometry=[box(*sample_gdf.total_bounds).buffer(max(service_areas))],
+                                      crs=sample_gdf.crs)
+
             for radius in service_areas:
 
                 edges['from'] = edges['from'].astype(int)
@@ -794,7 +1132,7 @@ class GeoBoundary:
                 buffers = {}
                 for key, values in aggregated_layers.items():
                     values = [f"{key}_ct"]+values
-                    gdf = gpd.read_file(self.gpkg, layer=key)
+                    gdf = self.layers.read(key, mask=extent, columns=values)
                     gdf.columns = [col_name.lower() for col_name in gdf.columns]
                     try: gdf.to_crs(epsg=self.crs, inplace=True)
                     except: gdf.crs = self.crs
@@ -891,7 +1229,7 @@ class GeoBoundary:
                     id_col = f'_r{radius}_'
                     if id_col in col:
                         r_ftr_list.append(col)
-            boundary = gpd.read_file(self.gpkg, layer='land_municipal_boundary')
+            boundary = self.layers['land_municipal_boundary']
             r_geometry = [boundary.at[0, 'geometry'].centroid for feature in r_ftr_list]
             r_features = gpd.GeoDataFrame({'features':r_ftr_list, 'geometry':r_geometry})
             r_features.to_file(self.gpkg, layer=f'{file_prefix}_aggregated_features')
@@ -1101,13 +1439,13 @@ class GeoBoundary:
         difference = gpd.overlay(node_b6, edges_b2, how="difference")
         difference['mpol_len'] = [len(mpol) if type(mpol)==type(MultiPolygon()) else 1 for mpol in difference.geometry]
         node = node.loc[difference['mpol_len'] > 2]
-        node.to_file(self.gpkg, layer='network_nodes')
+        self.layers['network_nodes'] = node
 
         # Remove islands
         if remove_islands: edges = edges[edges.intersects(node.unary_union)]
 
         # Export links and vertices
-        edges.to_file(self.gpkg, driver='GPKG', layer=f'network_links')
+        self.layers['network_links'] = edges
         vertices.to_file(self.gpkg, layer='network_vertices')
 
         elapsed = round((timeit.default_timer() - start_time) / 60, 1)
@@ -1116,7 +1454,7 @@ class GeoBoundary:
     def density_ratios(self, network=True, land=True):
 
         if network:
-            links = gpd.read_file(self.gpkg, layer='network_links')
+            links = self.layers['network_links']
 
         if land:
             pass
@@ -1131,7 +1469,7 @@ class GeoBoundary:
             start_time = timeit.default_timer()
 
             # Reproject GeoDataFrames
-            sample_gdf = gpd.read_file(self.gpkg, layer=sample_layer)
+            sample_gdf = self.layers[sample_layer]
             sample_gdf = sample_gdf.to_crs(epsg=self.crs)
             print(f'> Spatial join for {len(sample_gdf.geometry)} geometries and {aggregated_layers} layers')
 
@@ -1148,7 +1486,7 @@ class GeoBoundary:
                         try: sample_gdf = sample_gdf.drop('index_right', axis=1)
                         except: pass
 
-                        agg_gdf = gpd.read_file(self.gpkg, layer=layer)
+                        agg_gdf = self.layers[layer]
 
                         try: agg_gdf = agg_gdf.to_crs(self.crs)
                         except:
@@ -1181,7 +1519,7 @@ class GeoBoundary:
                             features = features + [f"{col}_{j}" for j in ['count', 'sum', 'mean', 'range', 'density']]
 
                         if len(features) > 0:
-                            boundary = gpd.read_file(self.gpkg, layer='land_municipal_boundary')
+                            boundary = self.layers['land_municipal_boundary']
                             f_geometry = [boundary.at[0, 'geometry'].centroid for feature in features]
                             features = gpd.GeoDataFrame({'features': features, 'geometry': f_geometry})
                             features.to_file(self.gpkg, layer=f'joined_features_{prefix}')
@@ -1197,7 +1535,7 @@ class GeoBoundary:
         if run:
             print(f"> Interpolating {feature} data from {layer} to {resolution}m grid")
 
-            gdf = gpd.read_file(self.gpkg, layer=layer).dropna(subset=['aqi'])
+            gdf = self.layers[layer].dropna(subset=['aqi'])
 
             if feature is None:
                 gdf['1'] = 1
@@ -1224,20 +1562,21 @@ class GeoBoundary:
             return print("> Data interpolated and saved")
 
     def set_parameters(self, service_areas, unit='lda', samples=None, max_area=7000000, elab_name='Sunset', bckp=True,
-                       layer='Optional GeoPackage layer to analyze', buffer_type='circular'):
+                       layer='Optional GeoPackage layer to analyze', buffer_type='circular', seed=None):
         # Load GeoDataFrame and assign layer name for LDA
         if unit == 'lda':
-            gdf = self.DAs.loc[self.DAs.geometry.area < max_area]
             layer = 'land_dissemination_area'
+            das = self.layers.read(layer, fids=True)
+            gdf = das.loc[das.geometry.area < max_area]
 
         # Pre process database for elementslab 1600x1600m 'Sandbox'
         elif unit == 'elab_sandbox':
             self.directory = 'Sandbox/'+elab_name
             self.gpkg = elab_name+'.gpkg'
             if 'PRCLS' in layer:
-                nodes_gdf = gpd.read_file(self.gpkg, layer='network_intersections')
-                links_gdf = gpd.read_file(self.gpkg, layer='network_streets')
-                cycling_gdf = gpd.read_file(self.gpkg, layer='network_cycling')
+                nodes_gdf = self.layers['network_intersections']
+                links_gdf = self.layers['network_streets']
+                cycling_gdf = self.layers['network_cycling']
                 if '2020' in layer:
                     self.nodes = nodes_gdf.loc[nodes_gdf['ctrld2020'] == 1]
                     self.links = links_gdf.loc[links_gdf['new'] == 0]
@@ -1249,7 +1588,7 @@ class GeoBoundary:
                     self.links = links_gdf
                     self.cycling = cycling_gdf
                     self.cycling['type'] = cycling_gdf['type2050']
-            self.properties = gpd.read_file(self.gpkg, layer=layer)
+            self.properties = self.layers.read(layer, fids=True)
             self.properties.crs = {'init': 'epsg:26910'}
 
             # Reclassify land uses and create bedroom and bathroom columns
@@ -1273,36 +1612,90 @@ class GeoBoundary:
 
             # Define GeoDataFrame
             # gdf = gpd.GeoDataFrame(geometry=self.properties.unary_union.convex_hull)
-            gdf = self.properties[['OBJECTID', 'geometry']]
+            gdf = self.properties[['OBJECTID', FID, 'geometry']]
             gdf.crs = {'init': 'epsg:26910'}
         else: gdf = None
 
         c_hull = gdf.geometry.unary_union.convex_hull
         if samples is not None:
-            gdf = gdf.sample(samples)
-            gdf.sindex()
-        self.gdfs = {}
-        buffers = {}
-        for radius in service_areas:
-            buffers[radius] = []
+            gdf = gdf.sample(samples, random_state=seed)
 
         if buffer_type == 'circular':
-            # Buffer polygons for cross-scale data aggregation and output one GeoDataframe for each scale of analysis
-            for row in gdf.iterrows():
-                geom = row[1].geometry
-                for radius in service_areas:
-                    lda_buffer = geom.centroid.buffer(radius)
-                    buffer_diff = lda_buffer.intersection(c_hull)
-                    buffers[radius].append(buffer_diff)
+            # Buffer polygons for cross-scale data aggregation, stored in one layer for all scales of analysis
+            self.buffers = self.buffer_store(gdf, service_areas, c_hull, layer)
+        else: print(f"!!! {buffer_type} buffer type not supported !!!")
 
-        for radius in service_areas:
-            self.gdfs['_r' + str(radius) + 'm'] = gpd.GeoDataFrame(geometry=buffers[radius], crs=gdf.crs)
-            sindex = self.gdfs['_r' + str(radius) + 'm'].sindex
-        self.params = {'gdf': gdf, 'service_areas': service_areas, 'layer': layer, 'backup': bckp}
-        print(self.gdfs)
-        print('Parameters set for ' + str(len(self.gdfs)) + ' spatial scales')
+        self.params = {'gdf': gdf, 'service_areas': service_areas, 'layer': layer, 'backup': bckp, 'c_hull': c_hull}
+
+        # Relate properties to sample centroids once at the largest radius, smaller radii are derived from distance bins
+        self.radial = {}
+        if hasattr(self, 'properties'): self.radial_membership('properties')
+        print('Parameters set for ' + str(len(service_areas)) + ' spatial scales')
         return self.params
 
+    def buffer_store(self, gdf, service_areas, c_hull, layer=''):
+        """
+        Buffer sample centroids to every radius and clip them to the convex hull of the samples. Buffers are stored in a
+        single long-format layer (sample, radius, geometry) named after digests of the sample layer and of the samples
+        and radii, with a spatial index in the GeoPackage, and reused by later runs with the same samples. Buffers of
+        the same sample layer with other samples or radii are dropped.
+
+        :param gdf: (GeoDataFrame) Sample features
+        :param service_areas: (list) Radii of analysis
+        :param c_hull: (Polygon) Convex hull to clip the buffers
+        :param layer: (str) Name of the sample layer
+        :return: GeoDataFrame with sample position, radius and buffer geometry
+        """
+
+        centroids = gpd.GeoSeries(list(gdf.geometry.centroid), crs=gdf.crs)
+        digest = hashlib.md5()
+        for value in [layer, sorted(service_areas), c_hull.wkb]+[pt.wkb for pt in centroids]:
+            digest.update(str(value).encode() if not isinstance(value, bytes) else value)
+        prefix = f"buffers_{hashlib.md5(str(layer).encode()).hexdigest()[:6]}_"
+        store = f"{prefix}{digest.hexdigest()[:12]}"
+
+        if store in self.layers:
+            buffers = self.layers[store]
+            print(f"> Buffers for {len(centroids)} samples read from {store} layer")
+        else:
+            start_time = timeit.default_timer()
+            rings = [centroids.buffer(radius).intersection(c_hull) for radius in service_areas]
+            buffers = gpd.GeoDataFrame({
+                'sample': np.tile(np.arange(len(centroids)), len(service_areas)),
+                'radius': np.repeat(service_areas, len(centroids))},
+                geometry=pd.concat(rings, ignore_index=True).values, crs=gdf.crs)
+            self.layers[store] = buffers
+            self.layers.drop([name for name in self.layers.list() if name.startswith(prefix) and name != store])
+            elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+            print(f"> Buffers for {len(centroids)} samples stored on {store} layer in {elapsed} minutes")
+
+        return buffers.sort_values(['radius', 'sample']).reset_index(drop=True)
+
+    def buffers_at(self, radius):
+        """
+        Get buffers of one radius from the buffer store, ordered by sample
+        """
+        return self.buffers.loc[self.buffers['radius'] == radius].reset_index(drop=True)
+
+    def radial_membership(self, name):
+        """
+        Get (and cache) distances from sample centroids to features of an attribute layer (i.e. properties, nodes,
+        links) within the largest service area, features outside the convex hull of the samples are not related
+
+        :param name: (str) Name of the GeoDataFrame attribute of the class
+        :return: DataFrame with sample and feature positions and their distance
+        """
+
+        if name not in self.radial:
+            start_time = timeit.default_timer()
+            features = getattr(self, name)
+            inside = features.geometry.centroid.within(self.params['c_hull'])
+            membership = radial_membership(self.params['gdf'], features, max(self.params['service_areas']))
+            self.radial[name] = membership.loc[inside.values[membership['feature'].values]]
+            elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+            print(f"> {len(self.radial[name])} {name}-sample relations found in {elapsed} minutes")
+        return self.radial[name]
+
     def geomorph_indicators(self):
         # 'Topographical Unevenness'
         gdf = self.params['gdf']
@@ -1310,7 +1703,7 @@ class GeoBoundary:
         dict_of_dicts = {}
         try:
             for radius in service_areas:
-                series = gdf.read_file(self.gpkg, layer='land_dissemination_area')[
+                series = gdf.read_file(self.gpkg, layer=self.params['layer'])[
                     'topo_unev_r' + str(radius) + 'm']
         except:
             start_time = timeit.default_timer()
@@ -1319,7 +1712,9 @@ class GeoBoundary:
             topo_unev = {}
             elevations = {}
             processed_keys = []
-            for in_gdf, key in zip(self.gdfs.values(), self.gdfs.keys()):
+            for radius in service_areas:
+                in_gdf = self.buffers_at(radius)
+                key = '_r' + str(radius) + 'm'
                 topo_unev[key] = []
 
                 for pol, i in zip(in_gdf.geometry, enumerate(in_gdf.geometry)):
@@ -1355,63 +1750,106 @@ class GeoBoundary:
             elapsed = round((timeit.default_timer() - start_time) / 60, 1)
             print('Topographical unevenness processed in ' + str(elapsed) + ' minutes')
 
+        columns = []
         for key, value in dict_of_dicts.items():
             for key2, value2 in value.items():
                 gdf[key + key2] = value2
+                columns.append(key + key2)
         print(gdf)
-        copyfile(self.gpkg, self.gpkg+'.bak')
-        gdf.to_file(self.gpkg, layer='land_dissemination_area')
+        self.layers.snapshot(self.params['layer'], **self.snapshots)
+        self.layers.upsert(self.params['layer'], gdf, columns)
         return gdf
 
-    def demographic_indicators(self):
-        unit = 'lda'
-        # WIP
-        census_gdf = gpd.read_file(self.census_file)
-        bound_gdf = gpd.read_file(self.gpkg, layer='land_census_subdivision')
-        bound_gdf.crs = {'init': 'epsg:3348'}
-        bound_gdf.to_crs({'init': 'epsg:4326'}, inplace=True)
-        city_lda = census_gdf[census_gdf.within(bound_gdf.geometry[0])]
-        print(city_lda)
-
-        # Set up driver for web scraping
-        options = Options()
-        options.set_preference("browser.download.folderList", 1)
-        options.set_preference("browser.download.manager.showWhenStarting", False)
-        options.set_preference("browser.helperApps.neverAsk.saveToDisk", "text/csv")
-        driver = webdriver.Firefox(executable_path=r'C:\WebDrivers\geckodriver.exe', options=options)
-        driver.set_page_load_timeout(1)
-
-        gdf = gpd.read_file('Databases/BC Assessment.gdb')
-        print(gdf)
+    def demographic_indicators(self, census_csv, characteristics=None, layer='land_dissemination_area',
+                               chunksize=500000):
+        """
+        Join characteristics of a bulk census profile (i.e. the DA-level comprehensive download file of StatCan) to
+        dissemination areas. The file is read in chunks, only rows of the characteristics and dissemination areas of
+        the layer are kept, then pivoted by DAUID and merged to the layer at once.
+
+        :param census_csv: (str) Path to the census profile CSV
+        :param characteristics: (dict) Characteristic (member) ids and the column names they are joined to, the ids of
+        the profile format (CENSUS_CHARACTERISTICS) if None
+        :param layer: (str) Layer of dissemination areas with a DAUID column
+        :param chunksize: (int) Number of rows read at a time
+        """
+        start_time = timeit.default_timer()
+        gdf = self.layers.read(layer, fids=True)
+        dauids = census_codes(gdf['DAUID'])
+
+        # Resolve columns of the 2016 (GEO_CODE, Member ID, Dim: Sex) or 2021 (ALT_GEO_CODE, CHARACTERISTIC_ID,
+        # C1_COUNT_TOTAL) profile formats
+        header = list(pd.read_csv(census_csv, nrows=0, encoding='latin-1').columns)
+        def find(*prefixes):
+            for prefix in prefixes:
+                for col in header:
+                    if col.startswith(prefix): return col
+            raise KeyError(f"None of the columns {prefixes} found on {census_csv}")
+        geo = find('GEO_CODE', 'ALT_GEO_CODE')
+        member = find('Member ID', 'CHARACTERISTIC_ID')
+        total = find('Dim: Sex (3): Member ID: [1]', 'C1_COUNT_TOTAL')
+        year = 2021 if geo.startswith('ALT_GEO_CODE') else 2016
+        if characteristics is None: characteristics = CENSUS_CHARACTERISTICS[year]
+
+        rows = []
+        reader = pd.read_csv(census_csv, usecols=[geo, member, total], dtype={geo: str}, encoding='latin-1',
+                             chunksize=chunksize)
+        for chunk in reader:
+            chunk[geo] = census_codes(chunk[geo])
+            chunk = chunk[chunk[member].isin(list(characteristics.keys())) & chunk[geo].isin(set(dauids))]
+            if len(chunk) > 0: rows.append(chunk)
+        if len(rows) == 0:
+            print(f"!!! No characteristics of {len(dauids)} dissemination areas found on {census_csv} !!!")
+            return None
+
+        table = pd.concat(rows).pivot_table(index=geo, columns=member, values=total, aggfunc='first')
+        table = table.rename(columns=characteristics).apply(pd.to_numeric, errors='coerce')
+        columns = [col for col in characteristics.values() if col in table.columns]
+        merged = table.reindex(dauids.values)[columns]
+        merged.index = gdf.index
+        for col in columns: gdf[col] = merged[col]
+        self.layers.upsert(layer, gdf, columns)
 
-        # Population density (census 2016)
-        if unit == 'lda':
-            for da, csd in zip(city_lda['DAUID'], city_lda['CSDUID']):
-                print(str(csd) + '-' + str(da))
-                url = 'https://www12.statcan.gc.ca/census-recensement/2016/dp-pd/prof/details/' \
-                      'download-telecharger/current-actuelle.cfm?Lang=E&Geo1=DA&Code1=' + da + '&Geo2=CSD&Code2=' \
-                      + csd + '&B1=All&type=0&FILETYPE=CSV'
-                print(url)
-                driver.get(url)
-        driver.close()
-        return None
+        elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+        print(f"> {len(columns)} census characteristics joined to {merged.notna().any(axis=1).sum()} dissemination "
+              f"areas in {elapsed} minutes")
+        return gdf
+
+    def density_indicators(self, mode='buffer', cell_size=10):
+        """
+        Process 'Parcel Density', 'Dwelling Density', 'Bedroom Density', 'Bathroom Density', 'Retail Density'
 
-    def density_indicators(self):
-        # Process 'Parcel Density', 'Dwelling Density', 'Bedroom Density', 'Bathroom Density', 'Retail Density'
+        :param mode: (str) 'buffer' sums properties within the buffers of each sample, 'raster' samples kernel density
+        surfaces at sample centroids, which cost is nearly independent of the number of samples
+        :param cell_size: (float) Size of the grid cells in raster mode
+        """
         gdf = self.params['gdf']
         layer = self.params['layer']
+        service_areas = self.params['service_areas']
         dict_of_dicts = {}
 
-        print('> Processing spatial density indicators')
+        print(f'> Processing spatial density indicators ({mode} mode)')
         start_time = timeit.default_timer()
 
-        # Drop index columns from previous processing
-        if 'index_right' in self.properties.columns:
-            self.properties.drop('index_right', axis=1, inplace=True)
-        if 'index_left' in self.properties.columns:
-            self.properties.drop('index_left', axis=1, inplace=True)
+        props = self.properties
+        residential = props['n_use'] == 'residential'
+        values = pd.DataFrame({
+            'parc': (~props.geometry.apply(lambda g: g.wkb).duplicated()).astype(int).values,
+            'dwell': residential.astype(int).values,
+            'bed': (props['NUMBER_OF_BEDROOMS'] * residential).values,
+            'bath': props['NUMBER_OF_BATHROOMS'].values,
+            'dest': props['n_use'].isin(['retail', 'office', 'entertainment']).astype(int).values,
+        })
+
+        if mode == 'raster':
+            sums, areas = self.density_surfaces(values, cell_size=cell_size)
+        else:
+            # Get properties within the largest radius and their distance to each sample, cumulative sums over
+            # distance bins give the totals within every radius
+            membership = self.radial_membership('properties')
+            sums = radial_sums(membership, values, service_areas, len(gdf))
+            areas = {radius: self.buffers_at(radius).geometry.area.values for radius in service_areas}
 
-        # Create empty dictionaries and lists
         parc_den = {}
         dwell_den = {}
         bed_den = {}
@@ -1419,54 +1857,16 @@ class GeoBoundary:
         dest_den = {}
         dest_ct = {}
         dwell_ct = {}
-
-        for geom, key in zip(self.gdfs.values(), self.gdfs.keys()):
-            parc_den[key] = []
-            dwell_den[key] = []
-            bed_den[key] = []
-            bath_den[key] = []
-            dest_den[key] = []
-            dest_ct[key] = []
-            dwell_ct[key] = []
-
-        # Iterate over GeoDataFrames
-        for geom, key in zip(self.gdfs.values(), self.gdfs.keys()):
-
-            if 'index_right' in geom.columns:
-                geom.drop('index_right', axis=1, inplace=True)
-            if 'index_left' in geom.columns:
-                geom.drop('index_left', axis=1, inplace=True)
-
-            jgdf = gpd.sjoin(geom, self.properties, how='right', op="intersects")
-            for id in range(len(gdf)):
-                fgdf = jgdf.loc[(jgdf['index_left'] == id)]
-                if len(fgdf) == 0:
-                    parc_den[key].append(0)
-                    dwell_den[key].append(0)
-                    bed_den[key].append(0)
-                    bath_den[key].append(0)
-                    dest_den[key].append(0)
-                    dwell_ct[key].append(0)
-                    dest_ct[key].append(0)
-
-                else:
-                    area = geom.loc[id].geometry.area
-
-                    parc_gdf = fgdf.drop_duplicates(subset='geometry')
-                    parc_den[key].append(len(parc_gdf)/area)
-
-                    dwell_gdf = fgdf.loc[fgdf['n_use'] == 'residential']
-                    dwell_den[key].append(len(dwell_gdf)/area)
-                    dwell_ct[key].append(len(dwell_gdf))
-
-                    bed_den[key].append(dwell_gdf['NUMBER_OF_BEDROOMS'].sum()/area)
-                    bath_den[key].append(fgdf['NUMBER_OF_BATHROOMS'].sum()/area)
-
-                    dest_gdf = fgdf.loc[(fgdf['n_use'] == 'retail') |
-                                        (fgdf['n_use'] == 'office') |
-                                        (fgdf['n_use'] == 'entertainment')]
-                    dest_den[key].append(len(dest_gdf)/area)
-                    dest_ct[key].append(len(dest_gdf))
+        for radius in service_areas:
+            key = '_r' + str(radius) + 'm'
+            area = areas[radius]
+            parc_den[key] = list(sums['parc'][radius].values / area)
+            dwell_den[key] = list(sums['dwell'][radius].values / area)
+            dwell_ct[key] = list(sums['dwell'][radius].values)
+            bed_den[key] = list(sums['bed'][radius].values / area)
+            bath_den[key] = list(sums['bath'][radius].values / area)
+            dest_den[key] = list(sums['dest'][radius].values / area)
+            dest_ct[key] = list(sums['dest'][radius].values)
 
         dict_of_dicts['parc_den'] = parc_den
         dict_of_dicts['dwell_ct'] = dwell_ct
@@ -1477,15 +1877,65 @@ class GeoBoundary:
         dict_of_dicts['dest_den'] = dest_den
 
         # Append all processed data to a single GeoDataFrame, backup and export
+        columns = []
         for key, value in dict_of_dicts.items():
             for key2, value2 in value.items():
                 gdf[key + key2] = value2
+                columns.append(key + key2)
         if self.params['backup']:
-            copyfile(self.gpkg, self.directory+'/ArchiveOSX/'+self.municipality+' - '+str(datetime.date.today())+'.gpkg')
-        gdf.to_file(self.gpkg, layer=layer, driver='GPKG')
+            self.layers.snapshot(layer, **self.snapshots)
+        self.layers.upsert(layer, gdf, columns)
         elapsed = round((timeit.default_timer() - start_time) / 60, 1)
         return print('Density indicators processed in ' + str(elapsed) + ' minutes @ ' + str(datetime.datetime.now()))
 
+    def density_surfaces(self, values, cell_size=10):
+        """
+        Rasterize property quantities at their centroids onto a grid covering the samples, convolve them with disc
+        kernels of every radius using FFT and sample the surfaces at sample centroids. Areas are the area of each disc
+        within the convex hull of the samples, as buffers are clipped to it.
+
+        :param values: (DataFrame) Numeric values of the properties, ordered by property position
+        :param cell_size: (float) Size of the grid cells in map units
+        :return: sums (dict of DataFrames samples x radii for each column of values) and areas (dict of arrays)
+        """
+
+        service_areas = self.params['service_areas']
+        c_hull = self.params['c_hull']
+        r_max = max(service_areas)
+
+        # Define grid covering the convex hull and the largest radius
+        xmin, ymin, xmax, ymax = c_hull.bounds
+        xmin, ymin = xmin - r_max, ymin - r_max
+        nx = int(math.ceil((xmax + r_max - xmin) / cell_size))
+        ny = int(math.ceil((ymax + r_max - ymin) / cell_size))
+        x_edges = xmin + np.arange(nx + 1) * cell_size
+        y_edges = ymin + np.arange(ny + 1) * cell_size
+        print(f"> Rasterizing {len(values.columns)} quantities onto a {nx}x{ny} grid of {cell_size}m cells")
+
+        # As in buffer mode, only properties whose centroid is within the convex hull are counted, and missing values
+        # are counted as zero so that they do not spread over the surfaces
+        pts = self.properties.geometry.centroid
+        keep = pts.within(c_hull).values
+        grids = [np.histogram2d(pts.x.values[keep], pts.y.values[keep], bins=[x_edges, y_edges],
+                                weights=np.nan_to_num(values[col].values.astype(float))[keep])[0]
+                 for col in values.columns]
+        cx, cy = np.meshgrid(x_edges[:-1] + cell_size / 2, y_edges[:-1] + cell_size / 2, indexing='ij')
+        inside = MplPath(np.array(c_hull.exterior.coords)).contains_points(np.column_stack([cx.ravel(), cy.ravel()]))
+        grids.append(inside.reshape(nx, ny).astype(float) * cell_size ** 2)
+
+        # Convolve grids with disc kernels and sample surfaces at sample centroids
+        surfaces = fft_disc_sums(grids, service_areas, cell_size)
+        centroids = self.params['gdf'].geometry.centroid
+        ix = np.clip(((centroids.x.values - xmin) // cell_size).astype(int), 0, nx - 1)
+        iy = np.clip(((centroids.y.values - ymin) // cell_size).astype(int), 0, ny - 1)
+
+        sums = {}
+        for i, col in enumerate(values.columns):
+            sums[col] = pd.DataFrame({radius: surfaces[radius][i][ix, iy] for radius in service_areas})
+            sums[col] = sums[col].clip(lower=0).round(6)
+        areas = {radius: surfaces[radius][-1][ix, iy] for radius in service_areas}
+        return sums, areas
+
     def diversity_indicators(self):
         # Process 'Land Use Diversity', 'Parcel Size Diversity', 'Dwelling Diversity'
         gdf = self.params['gdf']
@@ -1496,75 +1946,59 @@ class GeoBoundary:
         print('> Processing spatial diversity indicators')
         start_time = timeit.default_timer()
 
-        # Drop index columns from previous processing
-        if 'index_right' in self.properties.columns:
-            self.properties.drop('index_right', axis=1, inplace=True)
-        if 'index_left' in self.properties.columns:
-            self.properties.drop('index_left', axis=1, inplace=True)
-
-        # Create empty dictionaries and lists
+        # Get properties within the largest radius and their distance to each sample
+        membership = self.radial_membership('properties')
+        props = pd.DataFrame({
+            'n_use': self.properties['n_use'].values,
+            'PRIMARY_ACTUAL_USE': self.properties['PRIMARY_ACTUAL_USE'].values,
+            'parcel': (~self.properties.geometry.apply(lambda g: g.wkb).duplicated()).values,
+            'area_group': pd.cut(self.properties.geometry.area.values, bins=[0, 400, 800, 1600, 3200, 6400, np.inf],
+                labels=['<400', '400><800', '800><1600', '1600><3200', '3200><6400', '>6400']).astype(str),
+        })
+        joined = pd.concat([membership.reset_index(drop=True),
+                            props.iloc[membership['feature'].values].reset_index(drop=True)], axis=1)
+
+        def diversities(fgdf):
+            use_gdf = fgdf.loc[fgdf['n_use'].isin(['residential', 'entertainment', 'civic', 'retail', 'office'])]
+            res_gdf = fgdf.loc[(fgdf['n_use'] == 'residential')]
+            parcel_gdf = fgdf.loc[fgdf['parcel']]
+            return pd.Series({
+                'use_div': shannon_div(use_gdf, 'n_use'),
+                'dwell_div': shannon_div(res_gdf, 'PRIMARY_ACTUAL_USE'),
+                'parc_area_div': shannon_div(parcel_gdf, 'area_group')})
+
+        # Filter members of each radius from their distance bins
         use_div = {}
         dwell_div = {}
         parc_area_div = {}
-        for geom, key in zip(self.gdfs.values(), self.gdfs.keys()):
-            use_div[key] = []
-            dwell_div[key] = []
-            parc_area_div[key] = []
-
-        # Iterate over GeoDataFrames
-        for geom, key in zip(self.gdfs.values(), self.gdfs.keys()):
-
-            if 'index_right' in geom.columns:
-                geom.drop('index_right', axis=1, inplace=True)
-            if 'index_left' in geom.columns:
-                geom.drop('index_left', axis=1, inplace=True)
-
-            jgdf = gpd.sjoin(geom, self.properties, how='right', op="intersects")
-            for id in range(len(gdf)):
-                fgdf = jgdf.loc[(jgdf['index_left'] == id)]
-                if len(fgdf) == 0:
-                    use_div[key].append(0)
-                    dwell_div[key].append(0)
-                    parc_area_div[key].append(0)
-                else:
-                    use_gdf = fgdf.loc[(fgdf['n_use'] == 'residential') |
-                                       (fgdf['n_use'] == 'entertainment') |
-                                       (fgdf['n_use'] == 'civic') |
-                                       (fgdf['n_use'] == 'retail') |
-                                       (fgdf['n_use'] == 'office')]
-                    use_div[key].append(shannon_div(use_gdf, 'n_use'))
-
-                    res_gdf = fgdf.loc[(fgdf['n_use'] == 'residential')]
-                    dwell_div[key].append(shannon_div(res_gdf, 'PRIMARY_ACTUAL_USE'))
-
-                    parcel_gdf = fgdf.drop_duplicates(subset=['geometry'])
-                    parcel_gdf['area'] = parcel_gdf.geometry.area
-                    parcel_gdf.loc[parcel_gdf['area'] < 400, 'area_group'] = '<400'
-                    parcel_gdf.loc[(parcel_gdf['area'] > 400) & (parcel_gdf['area'] < 800), 'area_group'] = '400><800'
-                    parcel_gdf.loc[(parcel_gdf['area'] > 800) & (parcel_gdf['area'] < 1600), 'area_group'] = '800><1600'
-                    parcel_gdf.loc[(parcel_gdf['area'] > 1600) & (parcel_gdf['area'] < 3200), 'area_group'] = '1600><3200'
-                    parcel_gdf.loc[(parcel_gdf['area'] > 3200) & (parcel_gdf['area'] < 6400), 'area_group'] = '3200><6400'
-                    parcel_gdf.loc[parcel_gdf['area'] > 6400, 'area_group'] = '>6400'
-                    parc_area_div[key].append(shannon_div(parcel_gdf, 'area_group'))
+        for radius in service_areas:
+            key = '_r' + str(radius) + 'm'
+            divs = joined.loc[joined['distance'] <= radius].groupby('sample').apply(diversities)
+            divs = divs.reindex(range(len(gdf)), fill_value=0)
+            use_div[key] = list(divs['use_div'])
+            dwell_div[key] = list(divs['dwell_div'])
+            parc_area_div[key] = list(divs['parc_area_div'])
 
         dict_of_dicts['use_div'] = use_div
         dict_of_dicts['dwell_div'] = dwell_div
         dict_of_dicts['parc_area_div'] = parc_area_div
 
         # Append all processed data to a single GeoDataFrame, backup and export
+        columns = []
         for key, value in dict_of_dicts.items():
             for key2, value2 in value.items():
                 gdf[key + key2] = value2
+                columns.append(key + key2)
         if self.params['backup']:
-            copyfile(self.gpkg, self.directory+'/ArchiveOSX/'+self.municipality+' - '+str(datetime.date.today())+'.gpkg')
-        gdf.to_file(self.gpkg, layer=layer)
+            self.layers.snapshot(layer, **self.snapshots)
+        self.layers.upsert(layer, gdf, columns)
         elapsed = round((timeit.default_timer() - start_time) / 60, 1)
         return print('Diversity indicators processed in ' + str(elapsed) + ' minutes @ ' + str(datetime.datetime.now()))
 
     def align_network_edges(self, spacing=25):
 
         # Divide boundary into quadrants
-        bounds = gpd.read_file(self.gpkg, layer='land_municipal_boundary')
+        bounds = self.layers['land_municipal_boundary']
         bounds = bounds.to_crs(self.crs)
         quadrants = [pol for pol in ox.quadrat_cut_geometry(bounds.geometry[0], quadrat_width=spacing)]
 
@@ -1581,7 +2015,7 @@ class GeoBoundary:
         v_mpol = v_gdf.unary_union
 
         # Snap edges to quadrant vertices
-        net_gdf = gpd.read_file(self.gpkg, layer='network_links')
+        net_gdf = self.layers['network_links']
         n_lns = []
         for ln in net_gdf.geometry:
             p0 = Point(ln.coords[0])
@@ -1595,6 +2029,33 @@ class GeoBoundary:
         net_gdf.to_file(self.gpkg, layer='network_links_al')
         return
 
+    def buffer_members(self, features, predicate='within'):
+        """
+        Relate features to all buffers of the buffer store at once using a bulk spatial index query
+
+        :param features: (GeoDataFrame) Features to be related to the buffers
+        :param predicate: (str) Spatial predicate between features and buffers
+        :return: DataFrame with buffer and feature positions
+        """
+        ftr_idx, buf_idx = query_bulk(self.buffers, features.geometry, predicate=predicate)
+        return pd.DataFrame({'buffer': buf_idx, 'feature': ftr_idx})
+
+    def node_clusters(self, net_simperance=10):
+        """
+        Assign nodes whose buffers (of radius net_simperance) overlap to the same cluster, a cluster counts as one
+        intersection in the street network indicators
+        """
+        nodes = self.nodes
+        if self._node_digest[0] is not nodes: self._node_digest = (nodes, geometry_digest(nodes))
+        key = (net_simperance, len(nodes), self._node_digest[1])
+        if self._node_clusters[0] != key:
+            clusters = gpd.GeoSeries(nodes.geometry.buffer(net_simperance).unary_union).explode()
+            clusters = gpd.GeoDataFrame(geometry=list(clusters), crs=nodes.crs)
+            node_idx, cluster_idx = query_bulk(clusters, nodes.geometry, predicate='intersects')
+            cluster_ids = pd.Series(cluster_idx, index=node_idx).groupby(level=0).min()
+            self._node_clusters = (key, cluster_ids.reindex(range(len(nodes))).values)
+        return self._node_clusters[1]
+
     def street_network_indicators(self, net_simperance=10):
         # Define GeoDataframe sample_layer unit
         gdf = self.params['gdf']
@@ -1605,62 +2066,59 @@ class GeoBoundary:
         # 'Intersection Density', 'Link-node Ratio', 'Network Density', 'Average Street Length'
         start_time = timeit.default_timer()
         print('> Processing general network indicators')
-        intrs_den = {}
-        linkn_rat = {}
-        netw_den = {}
-        strt_len = {}
-        for geom, key in zip(self.gdfs.values(), self.gdfs.keys()):
-            intrs_den[key] = []
-            linkn_rat[key] = []
-            netw_den[key] = []
-            strt_len[key] = []
-            exceptions = []
-            for pol in geom.geometry:
-                nodes_w = self.nodes[self.nodes.geometry.within(pol)]
-                try:
-                    nodes_w = nodes_w.geometry.buffer(net_simperance).unary_union
-                    len_nodes_w = len(nodes_w)
-                    if len(nodes_w) == 0:
-                        len_nodes_w = 1
-                except:
-                    exceptions.append('exception')
-                    len_nodes_w = 1
-                intrs_den[key].append(round(len_nodes_w / (pol.area / 10000), 2))
-                edges_w = self.links[self.links.geometry.within(pol)]
-                len_edges_w = len(edges_w)
-                if len(edges_w) == 0:
-                    len_edges_w = 1
-                edges_w_geom_length = edges_w.geometry.length
-                if len(edges_w_geom_length) == 0:
-                    edges_w_geom_length = [1, 1]
-                linkn_rat[key].append(round(len_edges_w / len_nodes_w, 2))
-                netw_den[key].append(round(sum(edges_w_geom_length) / (pol.area / 10000), 5))
-                strt_len[key].append(round(sum(edges_w_geom_length) / len(edges_w_geom_length), 2))
-            print('Network iterations at the ' + key + ' scale finished with a total of ' + str(
-                  len(exceptions)) + ' exceptions')
-        dict_of_dicts['intrs_den'] = intrs_den
-        dict_of_dicts['linkn_rat'] = linkn_rat
-        dict_of_dicts['netw_den'] = netw_den
-        dict_of_dicts['strt_len'] = strt_len
+
+        # Get nodes and links within every buffer from the spatial index of the buffer store
+        buffers = pd.DataFrame({'radius': self.buffers['radius'], 'sample': self.buffers['sample'],
+                                'ha': self.buffers.geometry.area / 10000})
+        nodes_w = self.buffer_members(self.nodes)
+        nodes_w['cluster'] = self.node_clusters(net_simperance)[nodes_w['feature'].values]
+        edges_w = self.buffer_members(self.links)
+        edges_w['length'] = self.links.geometry.length.values[edges_w['feature'].values]
+
+        # Aggregate members of each buffer, empty buffers count one intersection and one link of unit length
+        buffers['len_nodes_w'] = nodes_w.groupby('buffer')['cluster'].nunique()
+        buffers['len_edges_w'] = edges_w.groupby('buffer')['length'].count()
+        buffers['sum_length'] = edges_w.groupby('buffer')['length'].sum()
+        buffers['len_nodes_w'] = buffers['len_nodes_w'].fillna(0).clip(lower=1)
+        no_edges = buffers['len_edges_w'].fillna(0) == 0
+        buffers.loc[no_edges, 'len_edges_w'] = 1
+        buffers.loc[no_edges, 'sum_length'] = 2
+        buffers['n_lengths'] = buffers['len_edges_w'].where(~no_edges, 2)
+
+        buffers['intrs_den'] = (buffers['len_nodes_w'] / buffers['ha']).round(2)
+        buffers['linkn_rat'] = (buffers['len_edges_w'] / buffers['len_nodes_w']).round(2)
+        buffers['netw_den'] = (buffers['sum_length'] / buffers['ha']).round(5)
+        buffers['strt_len'] = (buffers['sum_length'] / buffers['n_lengths']).round(2)
+
+        for indicator in ['intrs_den', 'linkn_rat', 'netw_den', 'strt_len']:
+            table = buffers.pivot(index='sample', columns='radius', values=indicator)
+            dict_of_dicts[indicator] = {'_r' + str(radius) + 'm': list(table[radius]) for radius in service_areas}
         elapsed = round((timeit.default_timer() - start_time) / 60, 1)
         print('General network indicators processed in ' + str(elapsed) + ' minutes')
 
+        columns = []
         for key, value in dict_of_dicts.items():
             for key2, value2 in value.items():
                 gdf[key + key2] = value2
-        copyfile(self.gpkg, self.gpkg+'.bak')
-        gdf.to_file(self.gpkg, layer=layer)
+                columns.append(key + key2)
+        self.layers.snapshot(layer, **self.snapshots)
+        self.layers.upsert(layer, gdf, columns)
         print('Processing finished @ ' + str(datetime.datetime.now()))
         return None
 
     def cycling_network_indicators(self):
-        # Read file and pre-process geometry according to its type
-        if str(type(self.cycling.geometry[0])) != "<class 'shapely.geometry.polygon.Polygon'>":
-            print('> Geometry is not polygon, buffering')
-            self.cycling.geometry = self.cycling.buffer(40)
+        # Read file and pre-process geometry according to its type, lines are buffered once and reused by later calls
+        if getattr(self, '_cycling_pol', (None, None))[0] is not self.cycling:
+            cycling_pol = self.cycling.loc[:, ['type', 'geometry']].copy()
+            if str(type(self.cycling.geometry[0])) != "<class 'shapely.geometry.polygon.Polygon'>":
+                print('> Geometry is not polygon, buffering')
+                cycling_pol.geometry = self.cycling.buffer(40)
+            self._cycling_pol = (self.cycling, cycling_pol.reset_index(drop=True))
+        cycling_pol = self._cycling_pol[1]
 
         gdf = self.params['gdf']
         layer = self.params['layer']
+        service_areas = self.params['service_areas']
 
         if 'index_left' in gdf.columns:
             gdf.drop(['index_left'], axis=1, inplace=True)
@@ -1671,53 +2129,37 @@ class GeoBoundary:
         start_time = timeit.default_timer()
         print('> Processing cycling network indicators')
 
-        onstreet = {}
-        offstreet = {}
-        informal = {}
-        all_cycl = {}
-        onstreet_gdf = self.cycling[self.cycling['type'] == 'onstreet']
-        offstreet_gdf = self.cycling[self.cycling['type'] == 'offstreet']
-        informal_gdf = self.cycling[self.cycling['type'] == 'informal']
-
-        for geom, key in zip(self.gdfs.values(), self.gdfs.keys()):
-            onstreet[key] = []
-            offstreet[key] = []
-            informal[key] = []
-            all_cycl[key] = []
-            for pol in geom.geometry:
-                onstreet_w = onstreet_gdf[onstreet_gdf.geometry.within(pol)]
-                offstreet_w = offstreet_gdf[offstreet_gdf.geometry.within(pol)]
-                informal_w = informal_gdf[informal_gdf.geometry.within(pol)]
-                all_cycl_w = gdf[gdf.geometry.within(pol)]
-                if len(onstreet_w.geometry) == 0: onstreet[key].append(0)
-                else: onstreet[key].append(sum(onstreet_w.geometry.area))
-                if len(offstreet_w.geometry) == 0: offstreet[key].append(0)
-                else: offstreet[key].append(sum(offstreet_w.geometry.area))
-                if len(informal_w.geometry) == 0: informal[key].append(0)
-                else: informal[key].append(sum(informal_w.geometry.area))
-                if len(all_cycl_w.geometry) == 0: all_cycl[key].append(0)
-                else: all_cycl[key].append(sum(all_cycl_w.geometry.area))
-        print(all_cycl)
-
-        dict_of_dicts['cycl_onstreet'] = onstreet
-        dict_of_dicts['cycl_offstreet'] = offstreet
-        dict_of_dicts['cycl_informal'] = informal
-        dict_of_dicts['all_cycl'] = all_cycl
-
+        # One bulk spatial index query for each cycling type against buffers of all radii
+        features = {
+            'cycl_onstreet': cycling_pol[cycling_pol['type'] == 'onstreet'],
+            'cycl_offstreet': cycling_pol[cycling_pol['type'] == 'offstreet'],
+            'cycl_informal': cycling_pol[cycling_pol['type'] == 'informal'],
+            'all_cycl': gdf}
+        for indicator, ftr_gdf in features.items():
+            members = self.buffer_members(ftr_gdf)
+            members['area'] = ftr_gdf.geometry.area.values[members['feature'].values]
+            areas = pd.DataFrame({'radius': self.buffers['radius'], 'sample': self.buffers['sample']})
+            areas['area'] = members.groupby('buffer')['area'].sum()
+            table = areas.fillna(0).pivot(index='sample', columns='radius', values='area')
+            dict_of_dicts[indicator] = {'_r' + str(radius) + 'm': list(table[radius]) for radius in service_areas}
+        print(dict_of_dicts['all_cycl'])
+
+        columns = []
         for key, value in dict_of_dicts.items():
             for key2, value2 in value.items():
                 gdf[key + key2] = value2
+                columns.append(key + key2)
         if self.params['backup']:
-            copyfile(self.gpkg, self.directory+'ArchiveOSX/'+self.municipality+' - '+str(datetime.date.today())+'.gpkg')
-        gdf.to_file(self.gpkg, layer=layer)
+            self.layers.snapshot(layer, **self.snapshots)
+        self.layers.upsert(layer, gdf, columns)
 
         elapsed = round((timeit.default_timer() - start_time) / 60, 1)
         return print('Cycling network indicators processed in ' + str(elapsed) + ' minutes')
 
     # Process results
     def network_report(self):
-        nodes_gdf = gpd.read_file(self.gpkg, layer='network_nodes')
-        links_gdf = gpd.read_file(self.gpkg, layer='network_links')
+        nodes_gdf = self.layers['network_nodes']
+        links_gdf = self.layers['network_links']
 
         # Setup directory parameters
         save_dir = f"{self.directory}Reports/"
@@ -1793,12 +2235,7 @@ class GeoBoundary:
         # Process geometry
         boundaries = self.DAs.geometry.boundary
         centroids = gpd.GeoDataFrame(geometry=self.DAs.geometry.centroid)
-        buffers = {'radius': [], 'geometry': []}
-        for radius in self.params['service_areas']:
-            for geom in centroids.geometry.buffer(radius):
-                buffers['radius'].append(radius)
-                buffers['geometry'].append(geom)
-        buffers_gdf = gpd.GeoDataFrame(buffers)
+        buffers_gdf = self.buffers
         buffer_bounds = gpd.GeoDataFrame(geometry=buffers_gdf['geometry'].boundary)
         buffer_bounds['radius'] = buffers_gdf['radius']
 
@@ -1819,7 +2256,7 @@ class GeoBoundary:
         return self
 
     def linear_correlation_lda(self):
-        gdf = gpd.read_file(self.gpkg, layer='land_dissemination_area')
+        gdf = self.layers['land_dissemination_area']
         gdf = gdf.loc[gdf.geometry.area < 7000000]
         r = gdf.corr(method='pearson')
         r.to_csv(self.directory + self.municipality + '_r.csv')
@@ -1850,7 +2287,7 @@ class GeoBoundary:
         directory = '/Users/nicholasmartino/Desktop/temp/'
         for layer in layers:
             print('Exporting layer: '+layer)
-            gdf = gpd.read_file(self.gpkg, layer=layer)
+            gdf = self.layers[layer]
             gdf.to_file(directory+self.municipality+' - '+layer+'.shp', driver='ESRI Shapefile')
         return self
 
@@ -0,0 +1,369 @@
+"""
+MIT License
+
+Copyright (c) 2020 Nicholas Martino
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import osmnx as ox
+import requests
+import urllib3
+from shapely.geometry import shape
+
+NOMINATIM = 'https://nominatim.openstreetmap.org/search'
+OVERPASS = 'https://overpass-api.de/api/interpreter'
+
+# Ways of the 'all_private' network type of OSMnx, a superset of every mode network and of the cycleways
+HIGHWAY_FILTER = '["highway"]["area"!~"yes"]["highway"!~"proposed|construction|abandoned|platform|raceway"]'
+
+
+class ResponseCache:
+    def __init__(self, directory, offline=False, max_age=None):
+        """
+        Persistent cache of HTTP responses. Requests are indexed by a digest of their method, url and parameters and
+        point to response bodies stored by the digest of their content, so identical responses are stored once.
+
+        :param directory: (str) Directory of the cache
+        :param offline: (bool) Replay responses from the cache only, requests that were not cached raise a KeyError
+        :param max_age: (float) Days after which cached responses are downloaded again, never if None
+        """
+        self.directory = directory
+        self.offline = offline
+        self.max_age = max_age
+        self.session = requests.Session()
+        for sub in ['requests', 'objects']:
+            os.makedirs(f"{directory}/{sub}", exist_ok=True)
+        return
+
+    @staticmethod
+    def key(method, url, params=None, data=None):
+        request = json.dumps([method.upper(), url, params, data], sort_keys=True, default=str)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def _object(self, digest):
+        return f"{self.directory}/objects/{digest[:2]}/{digest}"
+
+    def get(self, key):
+        """
+        Cached response body of a request key, None if not cached or expired
+        """
+        path = f"{self.directory}/requests/{key}.json"
+        if not os.path.exists(path): return None
+        with open(path) as file: entry = json.load(file)
+        if (self.max_age is not None) and (not self.offline):
+            age = datetime.datetime.now() - datetime.datetime.fromisoformat(entry['created'])
+            if age > datetime.timedelta(days=self.max_age): return None
+        if not os.path.exists(self._object(entry['object'])): return None
+        with open(self._object(entry['object']), 'rb') as file: return file.read()
+
+    def put(self, key, content, **request):
+        """
+        Store a response body and index it under a request key
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.tmp", 'wb') as file: file.write(content)
+            os.replace(f"{path}.tmp", path)
+        entry = dict(request, object=digest, size=len(content), created=datetime.datetime.now().isoformat())
+        with open(f"{self.directory}/requests/{key}.json", 'w') as file: json.dump(entry, file, default=str)
+        return digest
+
+    def fetch(self, url, params=None, data=None, method='GET', headers=None, timeout=180):
+        """
+        Response body of a request, from the cache when available
+
+        :return: (bytes) Response content
+        """
+        key = self.key(method, url, params, data)
+        content = self.get(key)
+        if content is not None:
+            print(f"> Response replayed from cache ({len(content)} bytes)")
+            return content
+        if self.offline: raise KeyError(f"Response of {method} {url} not cached, cannot download while offline")
+
+        start_time = timeit.default_timer()
+        response = self.session.request(method, url, params=params, data=data, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        self.put(key, response.content, method=method, url=url, params=params, data=data)
+        elapsed = round(timeit.default_timer() - start_time, 1)
+        print(f"> {len(response.content)} bytes downloaded from {url} in {elapsed} seconds")
+        return response.content
+
+
+def subset_ways(response, tag):
+    """
+    Subset of an Overpass response with the ways that have a tag and the nodes they reference
+
+    :param response: (dict) Overpass JSON response
+    :param tag: (str) Key of the tag that ways must have
+    :return: (dict) Overpass JSON response
+    """
+    ways = [e for e in response['elements'] if (e['type'] == 'way') and (tag in e.get('tags', {}))]
+    nodes = {node for way in ways for node in way['nodes']}
+    elements = [e for e in response['elements'] if (e['type'] == 'node') and (e['id'] in nodes)] + ways
+    return dict(response, elements=elements)
+
+
+def graph_from_response(response, polygon):
+    """
+    Simplified OSMnx graph of an Overpass response truncated to a polygon, as returned by ox.graph_from_place
+
+    :param response: (dict) Overpass JSON response
+    :param polygon: (Polygon or MultiPolygon) Boundary in EPSG:4326
+    """
+    try: g = ox.core.create_graph([response], retain_all=True)
+    except AttributeError: g = ox.graph._create_graph([response], bidirectional=False)
+
+    # Keep the nodes within the polygon and the largest weakly connected component
+    try: g = ox.truncate_graph_polygon(g, polygon, retain_all=False, truncate_by_edge=False)
+    except AttributeError:
+        g = ox.truncate.truncate_graph_polygon(g, polygon, truncate_by_edge=False)
+        try: g = ox.utils_graph.get_largest_component(g, strongly=False)
+        except AttributeError: g = ox.truncate.largest_component(g, strongly=False)
+    return ox.simplify_graph(g)
+
+
+class OpenStreetMap:
+    def __init__(self, cache, nominatim=NOMINATIM, overpass=OVERPASS, user_agent='elementslab', timeout=180):
+        """
+        Download OpenStreetMap boundaries and networks through a response cache
+
+        :param cache: (ResponseCache) Cache of responses
+        :param nominatim: (str) Url of the Nominatim search endpoint
+        :param overpass: (str) Url of the Overpass interpreter endpoint
+        """
+        self.cache = cache
+        self.nominatim = nominatim
+        self.overpass = overpass
+        self.headers = {'User-Agent': user_agent}
+        self.timeout = timeout
+        return
+
+    def boundary(self, place):
+        """
+        Boundary of a place geocoded by Nominatim, as returned by ox.gdf_from_place
+
+        :param place: (str) Place name, ex: 'Victoria, British Columbia'
+        :return: GeoDataFrame in EPSG:4326
+        """
+        params = {'format': 'json', 'limit': 1, 'dedupe': 0, 'polygon_geojson': 1, 'q': place}
+        results = json.loads(self.cache.fetch(self.nominatim, params=params, headers=self.headers))
+        if len(results) == 0: raise ValueError(f"Nominatim returned no results for {place}")
+        result = results[0]
+        south, north, west, east = [float(v) for v in result['boundingbox']]
+        return gpd.GeoDataFrame({
+            'place_name': [result['display_name']],
+            'bbox_north': [north], 'bbox_south': [south], 'bbox_east': [east], 'bbox_west': [west],
+        }, geometry=[shape(result['geojson'])], crs=4326)
+
+    def ways(self, polygon, filters=HIGHWAY_FILTER):
+        """
+        Overpass response with the ways matching filters within the convex hull of a polygon and their nodes
+
+        :param polygon: (Polygon or MultiPolygon) Boundary in EPSG:4326
+        :param filters: (str) Overpass QL filters of ways
+        :return: (dict) Overpass JSON response
+        """
+        coords = polygon.convex_hull.exterior.coords
+        poly = ' '.join(f'{y:.6f} {x:.6f}' for x, y in coords)
+        query = f'[out:json][timeout:{self.timeout}];(way{filters}(poly:"{poly}");>;);out;'
+        content = self.cache.fetch(self.overpass, data={'data': query}, method='POST', headers=self.headers,
+                                   timeout=self.timeout)
+        return json.loads(content)
+
+    def networks(self, polygon):
+        """
+        Street and cycleway graphs within a polygon from a single Overpass query, the cycleways are the ways of the
+        street network with a cycleway tag
+
+        :param polygon: (Polygon or MultiPolygon) Boundary in EPSG:4326
+        :return: (MultiDiGraph, MultiDiGraph) Street network and cycleway graphs
+        """
+        response = self.ways(polygon)
+        network = graph_from_response(response, polygon)
+        cycleway = graph_from_response(subset_ways(response, 'cycleway'), polygon)
+        print(f"> {len(network.edges)} street and {len(cycleway.edges)} cycleway edges built from one query")
+        return network, cycleway
+
+
+class DownloadManager:
+    def __init__(self, directory='.', chunk_size=2**20, min_chunk_size=2**16, max_chunk_size=2**24,
+                 retries=3, timeout=60):
+        """
+        Download files (one at a time or in parallel) with resume of interrupted transfers (HTTP Range on .part files),
+        conditional requests against the ETag/Last-Modified of previous downloads (kept in .meta.json files next to the
+        downloads) and SHA-256 checksum verification. Chunk sizes adapt to the transfer speed.
+
+        :param directory: (str) Directory of downloaded files without an explicit filename
+        :param chunk_size: (int) Initial chunk size in bytes
+        :param min_chunk_size: (int) Minimum chunk size in bytes
+        :param max_chunk_size: (int) Maximum chunk size in bytes
+        :param retries: (int) Attempts after a failed transfer, resuming from the bytes already written
+        :param timeout: (float) Seconds to wait for the server
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self._local = threading.local()
+        return
+
+    @property
+    def session(self):
+        # Sessions are not shared between threads
+        if not hasattr(self._local, 'session'): self._local.session = requests.Session()
+        return self._local.session
+
+    @staticmethod
+    def _read_json(path):
+        if not os.path.exists(path): return {}
+        with open(path) as file: return json.load(file)
+
+    @staticmethod
+    def _write_json(path, data):
+        with open(f"{path}.tmp", 'w') as file: json.dump(data, file)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def _digest(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(2**20), b''): digest.update(block)
+        return digest
+
+    @staticmethod
+    def _validators(response):
+        return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+    def download(self, url, filename=None, sha256=None):
+        """
+        Download a file unless the server reports that the copy from a previous download did not change
+
+        :param url: (str) Url of the file
+        :param filename: (str) Path of the downloaded file, named after the url within the directory if None
+        :param sha256: (str) Expected SHA-256 digest of the file, a ValueError is raised if it does not match
+        :return: (str) Path of the downloaded file
+        """
+        if filename is None: filename = f"{self.directory}/{url.split('?')[0].split('/')[-1]}"
+        if os.path.dirname(filename) != '': os.makedirs(os.path.dirname(filename), exist_ok=True)
+        meta_path, part, part_meta = f"{filename}.meta.json", f"{filename}.part", f"{filename}.part.json"
+        start_time = timeit.default_timer()
+
+        for attempt in range(self.retries + 1):
+            try:
+                # Offsets of ranged requests count encoded bytes, so files are transferred without content encoding
+                headers = {'Accept-Encoding': 'identity'}
+                meta = self._read_json(meta_path)
+                if os.path.exists(filename) and (meta.get('url') == url):
+                    if meta.get('etag'): headers['If-None-Match'] = meta['etag']
+                    if meta.get('last_modified'): headers['If-Modified-Since'] = meta['last_modified']
+
+                # Resume a partial transfer if the server still has the same version of the file
+                resume = self._read_json(part_meta)
+                offset = os.path.getsize(part) if os.path.exists(part) and (resume.get('url') == url) else 0
+                validator = resume.get('etag') or resume.get('last_modified')
+                if (offset > 0) and validator:
+                    headers['Range'] = f"bytes={offset}-"
+                    headers['If-Range'] = validator
+
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                    if r.status_code == 304:
+                        if (sha256 is None) or (self._digest(filename).hexdigest() == sha256.lower()):
+                            print(f"> {os.path.basename(filename)} not modified since last download")
+                            return filename
+                        # The copy on disk does not match the expected checksum, download it again unconditionally
+                        print(f"!!! Checksum of {os.path.basename(filename)} does not match, downloading again !!!")
+                        os.remove(meta_path)
+                        return self.download(url, filename, sha256=sha256)
+                    if r.status_code == 416:
+                        # Nothing left to transfer after the offset, the partial file is complete if it has the size of
+                        # the file on the server, otherwise it is discarded
+                        total = r.headers.get('Content-Range', '').split('/')[-1]
+                        if total.isdigit() and (int(total) == offset):
+                            digest = self._digest(part)
+                            validators = {k: resume.get(k) for k in ['etag', 'last_modified']}
+                            break
+                        print(f"!!! Partial download of {os.path.basename(filename)} is not valid, restarting !!!")
+                        for path in [part, part_meta]:
+                            if os.path.exists(path): os.remove(path)
+                        return self.download(url, filename, sha256=sha256)
+                    r.raise_for_status()
+                    if r.status_code != 206: offset = 0
+                    self._write_json(part_meta, dict(self._validators(r), url=url))
+
+                    digest = self._digest(part) if offset > 0 else hashlib.sha256()
+                    with open(part, 'ab' if offset > 0 else 'wb') as file:
+                        size = self.chunk_size
+                        while True:
+                            chunk_start = time.perf_counter()
+                            chunk = r.raw.read(size, decode_content=True)
+                            if not chunk: break
+                            file.write(chunk)
+                            digest.update(chunk)
+
+                            # Larger chunks on fast transfers, smaller ones on slow transfers
+                            seconds = time.perf_counter() - chunk_start
+                            if seconds < 0.25: size = min(size * 2, self.max_chunk_size)
+                            elif seconds > 1: size = max(size // 2, self.min_chunk_size)
+                    validators = self._validators(r)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                    urllib3.exceptions.HTTPError) as error:
+                if attempt == self.retries: raise
+                print(f"!!! Download of {url} interrupted ({error}), resuming !!!")
+                time.sleep(2 ** attempt)
+
+        checksum = digest.hexdigest()
+        if (sha256 is not None) and (checksum != sha256.lower()):
+            os.remove(part)
+            os.remove(part_meta)
+            raise ValueError(f"Checksum of {url} does not match, expected {sha256} and downloaded {checksum}")
+        os.replace(part, filename)
+        os.remove(part_meta)
+        self._write_json(meta_path, dict(validators, url=url, sha256=checksum, size=os.path.getsize(filename)))
+        elapsed = round(timeit.default_timer() - start_time, 1)
+        print(f"> {os.path.basename(filename)} downloaded ({os.path.getsize(filename)} bytes) in {elapsed} seconds")
+        return filename
+
+    def download_all(self, downloads, workers=4):
+        """
+        Download several files in parallel
+
+        :param downloads: (list) Urls, or dicts with the url, filename and sha256 arguments of download
+        :param workers: (int) Maximum number of simultaneous downloads
+        :return: (list) Paths of the downloaded files, in the same order
+        """
+        downloads = [{'url': d} if isinstance(d, str) else d for d in downloads]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda d: self.download(**d), downloads))
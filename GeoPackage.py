@@ -0,0 +1,1118 @@
+"""
+MIT License
+
+Copyright (c) 2020 Nicholas Martino
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import timeit
+
+import fiona
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from fiona import listlayers
+from shapely import wkb
+
+
+def sql_type(series):
+    """
+    SQLite (GeoPackage) column type for a pandas Series
+    """
+    if pd.api.types.is_bool_dtype(series): return 'BOOLEAN'
+    elif pd.api.types.is_integer_dtype(series): return 'INTEGER'
+    elif pd.api.types.is_float_dtype(series): return 'REAL'
+    elif pd.api.types.is_datetime64_any_dtype(series): return 'DATETIME'
+    else: return 'TEXT'
+
+
+def sql_values(series):
+    """
+    Python values of a pandas Series that can be bound to SQLite parameters, missing values become NULL
+    """
+    kind = sql_type(series)
+    if kind in ['BOOLEAN', 'INTEGER']: values = [None if pd.isna(v) else int(v) for v in series.astype(object)]
+    elif kind == 'REAL': values = series.astype(float).tolist()
+    elif kind == 'DATETIME':
+        values = [None if pd.isna(v) else v.strftime('%Y-%m-%dT%H:%M:%S.') + f'{v.microsecond // 1000:03d}Z'
+                  for v in series]
+    else: values = [None if v is None else str(v) for v in series.astype(object).tolist()]
+    return [None if (v is None) or (isinstance(v, float) and np.isnan(v)) else v for v in values]
+
+
+def quote(name):
+    """
+    Quote an SQL identifier
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def envelope(blob):
+    """
+    Envelope (minx, maxx, miny, maxy) of a GeoPackage geometry blob, None if the geometry is empty
+
+    :param blob: (bytes) Standard GeoPackage binary (GP header followed by WKB)
+    """
+    if blob is None: return None
+    flags = blob[3]
+    if flags & 0b10000: return None
+    order = '<' if flags & 1 else '>'
+    size = {0: 0, 1: 4, 2: 6, 3: 6, 4: 8}[(flags >> 1) & 0b111]
+    if size > 0: return struct.unpack(f'{order}4d', blob[8:40])
+    geom = wkb.loads(bytes(blob[8:]))
+    if geom.is_empty: return None
+    minx, miny, maxx, maxy = geom.bounds
+    return minx, maxx, miny, maxy
+
+
+def connect(gpkg):
+    """
+    Open a GeoPackage with sqlite3, registering the spatial functions used by the R*Tree triggers created by GDAL
+    """
+    con = sqlite3.connect(gpkg)
+    con.create_function('ST_IsEmpty', 1, lambda blob: None if blob is None else int(envelope(blob) is None))
+    for i, name in enumerate(['ST_MinX', 'ST_MaxX', 'ST_MinY', 'ST_MaxY']):
+        con.create_function(name, 1, lambda blob, i=i: None if envelope(blob) is None else envelope(blob)[i])
+    return con
+
+
+FID = 'fid'
+
+
+def layer_fids(gpkg, layer):
+    """
+    Feature ids of a GeoPackage layer, in the order its features are read by geopandas
+    """
+    con = sqlite3.connect(gpkg)
+    try:
+        pk = [row[1] for row in con.execute(f'PRAGMA table_info({quote(layer)})') if row[5] == 1][0]
+        return np.array([row[0] for row in con.execute(f'SELECT {quote(pk)} FROM {quote(layer)} ORDER BY {quote(pk)}')])
+    finally:
+        con.close()
+
+
+def upsert_columns(gpkg, layer, df, columns=None):
+    """
+    Add or update attribute columns of an existing GeoPackage layer in place. Columns are created with ALTER TABLE and
+    filled with a batched UPDATE keyed by feature id in one transaction, so geometries and other columns are not
+    rewritten. Rows of the DataFrame are matched to features by the feature ids of its fid column (see Layers.read),
+    a DataFrame without fids must have one row per feature, ordered as read.
+
+    :param gpkg: (str) Path to the GeoPackage
+    :param layer: (str) Layer name
+    :param df: (DataFrame) Data with the feature ids of the layer in a fid column, or the whole layer as read
+    :param columns: (list) Columns of df to write, all non-geometry columns if None
+    :return: (int) Number of features updated
+    """
+
+    if columns is None: columns = [col for col in df.columns if col not in ['geometry', FID]]
+    if (not os.path.exists(gpkg)) or (layer not in listlayers(gpkg)):
+        print(f"> {layer} layer not found, writing {len(df)} features to {os.path.basename(gpkg)}")
+        df.drop(columns=[FID], errors='ignore').to_file(gpkg, layer=layer, driver='GPKG')
+        return len(df)
+
+    fids = layer_fids(gpkg, layer)
+    if FID in df.columns:
+        keys = pd.Series(df[FID].values)
+        if keys.isna().any() or keys.duplicated().any():
+            raise ValueError(f"Feature ids of the rows to update on {layer} are missing or repeated")
+        missing = ~keys.isin(fids)
+        if missing.any():
+            raise ValueError(f"{missing.sum()} feature ids not found on the {len(fids)} features of {layer}, "
+                             f"ex: {keys[missing].iloc[0]}")
+        keys = keys.astype(int).tolist()
+    elif (len(df) == len(fids)) and (np.asarray(df.index) == np.arange(len(fids))).all():
+        keys = fids.tolist()
+    else:
+        raise ValueError(f"{len(df)} rows can not be matched to the {len(fids)} features of {layer} without a {FID} "
+                         f"column, read the layer with Layers.read(layer, fids=True)")
+
+    con = connect(gpkg)
+    try:
+        info = con.execute(f'PRAGMA table_info({quote(layer)})').fetchall()
+        existing = {row[1].lower(): row[1] for row in info}
+        pk = [row[1] for row in info if row[5] == 1][0]
+        names = [existing.get(col.lower(), col) for col in columns]
+        values = [sql_values(df[col]) for col in columns]
+        rows = list(zip(*values, keys))
+        assignments = ', '.join(f'{quote(name)} = ?' for name in names)
+
+        with con:
+            for col, name in zip(columns, names):
+                if name.lower() not in existing:
+                    con.execute(f'ALTER TABLE {quote(layer)} ADD COLUMN {quote(name)} {sql_type(df[col])}')
+            con.executemany(f'UPDATE {quote(layer)} SET {assignments} WHERE {quote(pk)} = ?', rows)
+            con.execute("UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') "
+                        "WHERE table_name = ?", (layer,))
+    finally:
+        con.close()
+    print(f"> {len(columns)} columns of {len(rows)} features updated on {layer} layer")
+    return len(rows)
+
+
+def geometry_blobs(geoms, srs_id, dimension=2):
+    """
+    Encode geometries as GeoPackage binaries (GP header with envelope followed by ISO WKB)
+
+    :param geoms: (GeoSeries) Geometries to encode
+    :param srs_id: (int) Spatial reference system id written in the headers
+    :param dimension: (int) Output dimension of the WKB, 3 for geometries with z coordinates
+    :return: (list, list) Blobs and envelopes (minx, maxx, miny, maxy), None for null or empty geometries
+    """
+    try:
+        import shapely
+        arr = np.asarray(geoms.values, dtype=object)
+        wkbs = shapely.to_wkb(arr, flavor='iso', output_dimension=dimension, byte_order=1)
+        bounds = shapely.bounds(arr).tolist()
+        missing, empty = shapely.is_missing(arr), shapely.is_empty(arr)
+        points = shapely.get_type_id(arr) == 0
+    except (ImportError, AttributeError, TypeError):
+        geoms = list(geoms)
+        missing = [g is None for g in geoms]
+        empty = [(g is not None) and g.is_empty for g in geoms]
+        points = [(g is not None) and (g.geom_type == 'Point') for g in geoms]
+        wkbs = [None if m else g.wkb for g, m in zip(geoms, missing)]
+        bounds = [(np.nan,) * 4 if m or e else g.bounds for g, m, e in zip(geoms, missing, empty)]
+
+    blobs, envelopes = [], []
+    for data, (minx, miny, maxx, maxy), m, e, p in zip(wkbs, bounds, missing, empty, points):
+        if m or (data is None):
+            blobs.append(None)
+            envelopes.append(None)
+        elif e:
+            blobs.append(b'GP' + struct.pack('<BBi', 0, 0b10001, srs_id) + data)
+            envelopes.append(None)
+        elif p:
+            blobs.append(b'GP' + struct.pack('<BBi', 0, 0b1, srs_id) + data)
+            envelopes.append((minx, maxx, miny, maxy))
+        else:
+            blobs.append(b'GP' + struct.pack('<BBi4d', 0, 0b11, srs_id, minx, maxx, miny, maxy) + data)
+            envelopes.append((minx, maxx, miny, maxy))
+    return blobs, envelopes
+
+
+RTREE_TRIGGERS = {
+    'insert': 'AFTER INSERT ON {t} WHEN (new.{g} NOT NULL AND NOT ST_IsEmpty(NEW.{g})) BEGIN '
+              'INSERT OR REPLACE INTO {r} VALUES (NEW.{f}, ST_MinX(NEW.{g}), ST_MaxX(NEW.{g}), ST_MinY(NEW.{g}), '
+              'ST_MaxY(NEW.{g})); END',
+    'update6': 'AFTER UPDATE OF {g} ON {t} WHEN OLD.{f} = NEW.{f} AND (NEW.{g} NOTNULL AND NOT ST_IsEmpty(NEW.{g})) '
+               'AND (OLD.{g} NOTNULL AND NOT ST_IsEmpty(OLD.{g})) BEGIN UPDATE {r} SET minx = ST_MinX(NEW.{g}), '
+               'maxx = ST_MaxX(NEW.{g}), miny = ST_MinY(NEW.{g}), maxy = ST_MaxY(NEW.{g}) WHERE id = NEW.{f}; END',
+    'update7': 'AFTER UPDATE OF {g} ON {t} WHEN OLD.{f} = NEW.{f} AND (NEW.{g} NOTNULL AND NOT ST_IsEmpty(NEW.{g})) '
+               'AND (OLD.{g} ISNULL OR ST_IsEmpty(OLD.{g})) BEGIN INSERT INTO {r} VALUES (NEW.{f}, ST_MinX(NEW.{g}), '
+               'ST_MaxX(NEW.{g}), ST_MinY(NEW.{g}), ST_MaxY(NEW.{g})); END',
+    'update2': 'AFTER UPDATE OF {g} ON {t} WHEN OLD.{f} = NEW.{f} AND (NEW.{g} ISNULL OR ST_IsEmpty(NEW.{g})) BEGIN '
+               'DELETE FROM {r} WHERE id = OLD.{f}; END',
+    'update5': 'AFTER UPDATE ON {t} WHEN OLD.{f} != NEW.{f} AND (NEW.{g} NOTNULL AND NOT ST_IsEmpty(NEW.{g})) BEGIN '
+               'DELETE FROM {r} WHERE id = OLD.{f}; INSERT OR REPLACE INTO {r} VALUES (NEW.{f}, ST_MinX(NEW.{g}), '
+               'ST_MaxX(NEW.{g}), ST_MinY(NEW.{g}), ST_MaxY(NEW.{g})); END',
+    'update4': 'AFTER UPDATE ON {t} WHEN OLD.{f} != NEW.{f} AND (NEW.{g} ISNULL OR ST_IsEmpty(NEW.{g})) BEGIN '
+               'DELETE FROM {r} WHERE id IN (OLD.{f}, NEW.{f}); END',
+    'delete': 'AFTER DELETE ON {t} WHEN old.{g} NOT NULL BEGIN DELETE FROM {r} WHERE id = OLD.{f}; END',
+}
+
+
+class LayerWriter:
+    def __init__(self, gpkg, cache=None):
+        """
+        Collect several layers and write them to a GeoPackage through one connection and one transaction (in WAL
+        mode) when the context exits, instead of reopening and committing the file once per layer.
+
+        with LayerWriter(gpkg) as writer:
+            writer['network_walk'] = walking_net
+            writer['network_drive'] = driving_net
+
+        :param gpkg: (str) Path to the GeoPackage
+        :param cache: (Layers) Layers cache to refresh after writing
+        """
+        self.gpkg = gpkg
+        self.cache = cache
+        self.pending = {}
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None: self.commit()
+        else: self.pending = {}
+        return False
+
+    def __setitem__(self, layer, gdf):
+        # Copy so that later changes to the GeoDataFrame do not leak into what is written
+        self.pending[layer] = gdf.copy()
+
+    def add(self, layer, gdf):
+        self[layer] = gdf
+        return
+
+    def commit(self):
+        """
+        Write all collected layers, replacing existing layers with the same names
+        """
+        if len(self.pending) == 0: return
+        start_time = timeit.default_timer()
+        before = None if self.cache is None else self.cache.stamp()
+        pending = dict(self.pending)
+
+        # The GeoPackage core tables are created by the driver when the file does not exist yet
+        if not os.path.exists(self.gpkg):
+            layer = list(pending.keys())[0]
+            pending.pop(layer).to_file(self.gpkg, layer=layer, driver='GPKG')
+
+        con = connect(self.gpkg)
+        con.isolation_level = None
+        try:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            con.execute('BEGIN')
+            for layer, gdf in pending.items():
+                self.drop(con, layer)
+                self.create(con, layer, gdf)
+            con.execute('COMMIT')
+        except:
+            if con.in_transaction: con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+
+        written = self.pending
+        self.pending = {}
+        if self.cache is not None: self.cache.refresh(before, written)
+        elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+        print(f"> {len(written)} layers written to {os.path.basename(self.gpkg)} in {elapsed} minutes")
+        return
+
+    @staticmethod
+    def tables(con):
+        return [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")]
+
+    def drop(self, con, layer):
+        """
+        Drop a layer table, its spatial index and its records on the GeoPackage metadata tables
+        """
+        tables = self.tables(con)
+        for (column,) in con.execute('SELECT column_name FROM gpkg_geometry_columns WHERE lower(table_name) = lower(?)',
+                                     (layer,)).fetchall():
+            con.execute(f'DROP TABLE IF EXISTS {quote(f"rtree_{layer}_{column}")}')
+        con.execute(f'DROP TABLE IF EXISTS {quote(layer)}')
+        for meta in ['gpkg_contents', 'gpkg_geometry_columns', 'gpkg_extensions', 'gpkg_ogr_contents',
+                     'gpkg_data_columns']:
+            if meta in tables: con.execute(f'DELETE FROM {meta} WHERE lower(table_name) = lower(?)', (layer,))
+        return
+
+    def srs_id(self, con, crs):
+        """
+        Spatial reference system id of a CRS, registered on gpkg_spatial_ref_sys if needed
+        """
+        if crs is None: return -1
+        from pyproj import CRS
+        crs = CRS.from_user_input(crs)
+        epsg = crs.to_epsg()
+        if epsg is not None:
+            srs_id, organization = epsg, 'EPSG'
+            if con.execute('SELECT 1 FROM gpkg_spatial_ref_sys WHERE srs_id = ?', (srs_id,)).fetchone() is not None:
+                return srs_id
+        else:
+            wkt = crs.to_wkt('WKT1_GDAL')
+            row = con.execute('SELECT srs_id FROM gpkg_spatial_ref_sys WHERE definition = ?', (wkt,)).fetchone()
+            if row is not None: return row[0]
+            srs_id = max(100000, con.execute('SELECT max(srs_id) + 1 FROM gpkg_spatial_ref_sys').fetchone()[0])
+            organization = 'NONE'
+        con.execute('INSERT INTO gpkg_spatial_ref_sys (srs_name, srs_id, organization, organization_coordsys_id, '
+                    'definition, description) VALUES (?, ?, ?, ?, ?, ?)',
+                    (crs.name, srs_id, organization, srs_id, crs.to_wkt('WKT1_GDAL'), None))
+        return srs_id
+
+    def create(self, con, layer, gdf):
+        """
+        Create a feature table with its spatial index and register it on the GeoPackage metadata tables
+        """
+        tables = self.tables(con)
+        geoms = gdf.geometry
+        columns = [col for col in gdf.columns if col != geoms.name]
+        srs_id = self.srs_id(con, gdf.crs)
+
+        # Geometry type, promoted to multi-part when single and multi-part geometries are mixed
+        types = set(geoms.dropna().geom_type.unique())
+        if len(types) == 1: geom_type = list(types)[0].upper()
+        elif (len(types) == 2) and any(f'Multi{t}' in types for t in types):
+            geom_type = [t for t in types if t.startswith('Multi')][0].upper()
+        else: geom_type = 'GEOMETRY'
+        z = int(bool(geoms.has_z.any())) if len(geoms) > 0 else 0
+        blobs, envelopes = geometry_blobs(geoms, srs_id, dimension=3 if z else 2)
+
+        fields = ', '.join(f'{quote(col)} {sql_type(gdf[col])}' for col in columns)
+        con.execute(f'CREATE TABLE {quote(layer)} ("fid" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, '
+                    f'"geom" {geom_type}{", " + fields if len(columns) > 0 else ""})')
+        values = [sql_values(gdf[col]) for col in columns]
+        rows = zip(range(1, len(gdf) + 1), blobs, *values)
+        marks = ', '.join(['?'] * (len(columns) + 2))
+        con.executemany(f'INSERT INTO {quote(layer)} VALUES ({marks})', rows)
+
+        # Spatial index
+        rtree = f'rtree_{layer}_geom'
+        con.execute(f'CREATE VIRTUAL TABLE {quote(rtree)} USING rtree(id, minx, maxx, miny, maxy)')
+        con.executemany(f'INSERT INTO {quote(rtree)} VALUES (?, ?, ?, ?, ?)',
+                        ((fid, *env) for fid, env in zip(range(1, len(gdf) + 1), envelopes) if env is not None))
+        for name, trigger in RTREE_TRIGGERS.items():
+            con.execute(f'CREATE TRIGGER {quote(f"{rtree}_{name}")} ' +
+                        trigger.format(t=quote(layer), g='"geom"', f='"fid"', r=quote(rtree)))
+
+        # Metadata
+        valid = [env for env in envelopes if env is not None]
+        if len(valid) > 0:
+            env = np.array(valid)
+            extent = (env[:, 0].min(), env[:, 2].min(), env[:, 1].max(), env[:, 3].max())
+        else: extent = (None, None, None, None)
+        con.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, description, last_change, min_x, "
+                    "min_y, max_x, max_y, srs_id) VALUES (?, 'features', ?, '', "
+                    "strftime('%Y-%m-%dT%H:%M:%fZ', 'now'), ?, ?, ?, ?, ?)", (layer, layer, *extent, srs_id))
+        con.execute('INSERT INTO gpkg_geometry_columns (table_name, column_name, geometry_type_name, srs_id, z, m) '
+                    "VALUES (?, 'geom', ?, ?, ?, 0)", (layer, geom_type, srs_id, z))
+        if 'gpkg_extensions' not in tables:
+            con.execute('CREATE TABLE gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT '
+                        'NULL, definition TEXT NOT NULL, scope TEXT NOT NULL, CONSTRAINT ge_tce UNIQUE (table_name, '
+                        'column_name, extension_name))')
+        con.execute("INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', "
+                    "'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')", (layer,))
+        if 'gpkg_ogr_contents' in tables:
+            con.execute('INSERT INTO gpkg_ogr_contents (table_name, feature_count) VALUES (?, ?)', (layer, len(gdf)))
+            for name, op in [('insert', 'INSERT'), ('delete', 'DELETE')]:
+                sign = '+' if op == 'INSERT' else '-'
+                con.execute(f'CREATE TRIGGER {quote(f"trigger_{name}_feature_count_{layer}")} AFTER {op} ON '
+                            f'{quote(layer)} BEGIN UPDATE gpkg_ogr_contents SET feature_count = feature_count {sign} '
+                            f'1 WHERE lower(table_name) = lower(\'{layer}\'); END')
+        print(f"> {len(gdf)} features written to {layer} layer")
+        return
+
+
+# Prefix of the tables used internally to keep snapshots, stages and scenarios
+INTERNAL = 'elab_'
+SNAPSHOTS = f'{INTERNAL}snapshots'
+
+
+def _snapshot_connection(gpkg, archive=None):
+    """
+    Connection to a GeoPackage and the schema where its snapshots are kept, the GeoPackage itself or an attached
+    sidecar archive, with the snapshots index table created if needed
+    """
+    con = connect(gpkg)
+    con.isolation_level = None
+    schema = 'main'
+    if archive is not None:
+        con.execute('ATTACH DATABASE ? AS archive', (archive,))
+        schema = 'archive'
+    con.execute(f'CREATE TABLE IF NOT EXISTS {schema}.{SNAPSHOTS} (snapshot TEXT PRIMARY KEY, table_name TEXT NOT '
+                f'NULL, version INTEGER NOT NULL, created TEXT NOT NULL, features INTEGER, definition TEXT, '
+                f'triggers TEXT)')
+    if schema == 'main':
+        # Registering an attribute table stops GDAL from listing the unregistered snapshot tables as layers
+        con.execute(f"INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier) "
+                    f"VALUES ('{SNAPSHOTS}', 'attributes', '{SNAPSHOTS}')")
+    return con, schema
+
+
+def snapshot_layer(gpkg, layer, archive=None, keep=3, days=None):
+    """
+    Copy the table of one layer before it is overwritten, instead of copying the whole GeoPackage. Snapshots are plain
+    tables (not registered as layers) stored in the GeoPackage itself or in a sidecar SQLite archive, and indexed with
+    a version number per layer so that they can be listed and restored.
+
+    :param gpkg: (str) Path to the GeoPackage
+    :param layer: (str) Layer name
+    :param archive: (str) Path to the sidecar archive, snapshots are kept inside the GeoPackage if None
+    :param keep: (int) Number of most recent snapshots of the layer to retain, all are kept if None
+    :param days: (float) Remove snapshots of the layer older than this number of days, regardless of keep
+    :return: (str) Name of the snapshot table, None if the layer does not exist
+    """
+    if (not os.path.exists(gpkg)) or (layer not in listlayers(gpkg)): return None
+    start_time = timeit.default_timer()
+    con, schema = _snapshot_connection(gpkg, archive)
+    try:
+        created = datetime.datetime.now()
+        snapshot = f"{layer}_snapshot_{created.strftime('%Y%m%dT%H%M%S%f')}"
+        definition = con.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                                 (layer,)).fetchone()[0]
+        triggers = [row[0] for row in con.execute("SELECT sql FROM main.sqlite_master WHERE type = 'trigger' AND "
+                                                  "tbl_name = ?", (layer,))]
+        con.execute('BEGIN')
+        version = con.execute(f'SELECT coalesce(max(version), 0) + 1 FROM {schema}.{SNAPSHOTS} WHERE table_name = ?',
+                              (layer,)).fetchone()[0]
+        con.execute(f'CREATE TABLE {schema}.{quote(snapshot)} AS SELECT * FROM main.{quote(layer)}')
+        features = con.execute(f'SELECT count(*) FROM {schema}.{quote(snapshot)}').fetchone()[0]
+        con.execute(f'INSERT INTO {schema}.{SNAPSHOTS} VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (snapshot, layer, version, created.isoformat(), features, definition, json.dumps(triggers)))
+
+        # Retention
+        rows = con.execute(f'SELECT snapshot, created FROM {schema}.{SNAPSHOTS} WHERE table_name = ? '
+                           f'ORDER BY version DESC', (layer,)).fetchall()
+        expired = [] if keep is None else [row[0] for row in rows[keep:]]
+        if days is not None:
+            limit = created - datetime.timedelta(days=days)
+            expired += [row[0] for row in rows if datetime.datetime.fromisoformat(row[1]) < limit]
+        for name in set(expired) - {snapshot}:
+            con.execute(f'DROP TABLE IF EXISTS {schema}.{quote(name)}')
+            con.execute(f'DELETE FROM {schema}.{SNAPSHOTS} WHERE snapshot = ?', (name,))
+        con.execute('COMMIT')
+    except:
+        if con.in_transaction: con.execute('ROLLBACK')
+        raise
+    finally:
+        con.close()
+    elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+    print(f"> {layer} layer snapshot v{version} with {features} features saved in {elapsed} minutes")
+    return snapshot
+
+
+def list_snapshots(gpkg, layer=None, archive=None):
+    """
+    Snapshots of a GeoPackage, or of one of its layers, from the most recent
+
+    :return: (DataFrame) snapshot, table_name, version, created and features
+    """
+    con, schema = _snapshot_connection(gpkg, archive)
+    try:
+        query = f'SELECT snapshot, table_name, version, created, features FROM {schema}.{SNAPSHOTS}'
+        if layer is None: df = pd.read_sql(f'{query} ORDER BY created DESC', con)
+        else: df = pd.read_sql(f'{query} WHERE table_name = ? ORDER BY version DESC', con, params=(layer,))
+    finally:
+        con.close()
+    return df
+
+
+def restore_layer(gpkg, layer, version=None, archive=None):
+    """
+    Restore a layer from a snapshot, with the table definition, spatial index and triggers it had when the snapshot
+    was taken
+
+    :param gpkg: (str) Path to the GeoPackage
+    :param layer: (str) Layer name
+    :param version: (int) Snapshot version, the most recent if None
+    :param archive: (str) Path to the sidecar archive where the snapshot is kept, None if kept in the GeoPackage
+    :return: (str) Name of the snapshot table restored
+    """
+    con, schema = _snapshot_connection(gpkg, archive)
+    try:
+        query = f'SELECT snapshot, version, features, definition, triggers FROM {schema}.{SNAPSHOTS} ' \
+                f'WHERE table_name = ?'
+        if version is None: row = con.execute(f'{query} ORDER BY version DESC LIMIT 1', (layer,)).fetchone()
+        else: row = con.execute(f'{query} AND version = ?', (layer, version)).fetchone()
+        if row is None: raise KeyError(f"Snapshot of {layer} layer not found")
+        snapshot, version, features, definition, triggers = row
+        geom = con.execute('SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?', (layer,)).fetchone()
+
+        con.execute('BEGIN')
+        con.execute(f'DROP TABLE IF EXISTS main.{quote(layer)}')
+        con.execute(definition)
+        con.execute(f'INSERT INTO main.{quote(layer)} SELECT * FROM {schema}.{quote(snapshot)}')
+        if geom is not None:
+            pk = [r[1] for r in con.execute(f'PRAGMA main.table_info({quote(layer)})') if r[5] == 1][0]
+            rtree, g = quote(f'rtree_{layer}_{geom[0]}'), quote(geom[0])
+            con.execute(f'DELETE FROM main.{rtree}')
+            con.execute(f'INSERT INTO main.{rtree} SELECT {quote(pk)}, ST_MinX({g}), ST_MaxX({g}), ST_MinY({g}), '
+                        f'ST_MaxY({g}) FROM main.{quote(layer)} WHERE {g} NOT NULL AND NOT ST_IsEmpty({g})')
+        for trigger in json.loads(triggers): con.execute(trigger)
+        if 'gpkg_ogr_contents' in LayerWriter.tables(con):
+            con.execute('UPDATE gpkg_ogr_contents SET feature_count = ? WHERE lower(table_name) = lower(?)',
+                        (features, layer))
+        con.execute("UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE table_name = ?",
+                    (layer,))
+        con.execute('COMMIT')
+    except:
+        if con.in_transaction: con.execute('ROLLBACK')
+        raise
+    finally:
+        con.close()
+    print(f"> {layer} layer restored from snapshot v{version}")
+    return snapshot
+
+
+STAGES = f'{INTERNAL}stages'
+
+
+def stage_digest(gpkg, stage):
+    """
+    Digest of the inputs of a processing stage recorded on a GeoPackage, None if the stage was never recorded
+    """
+    if not os.path.exists(gpkg): return None
+    con = sqlite3.connect(gpkg)
+    try:
+        if con.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (STAGES,)).fetchone() is None: return None
+        row = con.execute(f'SELECT digest FROM {STAGES} WHERE stage = ?', (stage,)).fetchone()
+    finally:
+        con.close()
+    return None if row is None else row[0]
+
+
+def record_stage(gpkg, stage, digest):
+    """
+    Record the digest of the inputs of a processing stage whose outputs were written to a GeoPackage, so that the
+    stage can be skipped while its inputs do not change
+    """
+    con = sqlite3.connect(gpkg)
+    try:
+        with con:
+            con.execute(f'CREATE TABLE IF NOT EXISTS {STAGES} (stage TEXT PRIMARY KEY, digest TEXT NOT NULL, '
+                        f'created TEXT NOT NULL)')
+            con.execute(f"INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier) "
+                        f"VALUES ('{STAGES}', 'attributes', '{STAGES}')")
+            con.execute(f'INSERT OR REPLACE INTO {STAGES} VALUES (?, ?, ?)',
+                        (stage, digest, datetime.datetime.now().isoformat()))
+    finally:
+        con.close()
+    return
+
+
+def last_changes(gpkg, layers):
+    """
+    Time of the last change of each layer recorded on the GeoPackage metadata, None for layers that do not exist
+    """
+    if not os.path.exists(gpkg): return [None for layer in layers]
+    con = sqlite3.connect(gpkg)
+    try:
+        changes = dict(con.execute('SELECT table_name, last_change FROM gpkg_contents').fetchall())
+    finally:
+        con.close()
+    return [changes.get(layer) for layer in layers]
+
+
+SCENARIOS = f'{INTERNAL}scenarios'
+DELTAS = f'{INTERNAL}scenario_deltas'
+
+
+def scenario_index(gpkg):
+    """
+    Experiment layers stored as deltas on a GeoPackage
+
+    :return: (dict) Layer names and their name, experiment, baseline and key
+    """
+    if not os.path.exists(gpkg): return {}
+    con = sqlite3.connect(gpkg)
+    try:
+        if con.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (SCENARIOS,)).fetchone() is None: return {}
+        rows = con.execute(f'SELECT layer, name, experiment, baseline, key FROM {SCENARIOS}').fetchall()
+    finally:
+        con.close()
+    return {row[0]: {'name': row[1], 'experiment': row[2], 'baseline': row[3], 'key': row[4]} for row in rows}
+
+
+def _json_value(value):
+    if isinstance(value, (list, tuple, dict)): return value
+    if pd.isna(value): return None
+    if hasattr(value, 'item'): return value.item()
+    if isinstance(value, (pd.Timestamp, datetime.datetime, datetime.date)): return value.isoformat()
+    return value
+
+
+class ScenarioStore:
+    def __init__(self, layers, name, baseline='e0', key=None):
+        """
+        Layers of design experiments ({name}_{experiment}) stored as one baseline layer plus the features added, dropped
+        or modified by each experiment, keyed by feature id. Experiments are materialized on demand as GeoDataFrames.
+
+        :param layers: (Layers) Layers of the GeoPackage
+        :param name: (str) Prefix of the experiment layers, ex: 'land_parcels' for land_parcels_e0, land_parcels_e1
+        :param baseline: (str) Experiment stored in full
+        :param key: (str) Column identifying features across experiments, geometries are used if None
+        """
+        self.layers = layers
+        self.gpkg = layers.gpkg
+        self.name = name
+        self.baseline = baseline
+        self.key = key
+        return
+
+    def layer(self, experiment):
+        return f"{self.name}_{experiment}"
+
+    def experiments(self):
+        """
+        Experiments stored as deltas of the baseline
+        """
+        return [v['experiment'] for k, v in scenario_index(self.gpkg).items()
+                if (v['name'] == self.name) and (v['baseline'] == self.layer(self.baseline))]
+
+    def keys(self, gdf):
+        """
+        Feature ids of a layer, repeated ids are numbered by order of appearance
+        """
+        if self.key is not None: keys = gdf[self.key].astype(str)
+        else:
+            try:
+                import shapely
+                wkbs = shapely.to_wkb(np.asarray(gdf.geometry.values, dtype=object))
+            except (ImportError, AttributeError, TypeError):
+                wkbs = [None if g is None else g.wkb for g in gdf.geometry]
+            keys = pd.Series([hashlib.sha1(w).hexdigest() if w is not None else 'None' for w in wkbs], index=gdf.index)
+        keys = keys.reset_index(drop=True)
+        n = keys.groupby(keys).cumcount()
+        return pd.Index(keys.where(n == 0, keys + '#' + n.astype(str)))
+
+    def diff(self, base, gdf):
+        """
+        Features of gdf that are not in base, features of base that are not in gdf and attributes (or geometries)
+        that changed
+
+        :return: (list, bytes) Delta rows (key, op, geometry, attributes) and positions of features if their order
+        differs from base
+        """
+        geom = gdf.geometry.name
+        base_keys, keys = self.keys(base), self.keys(gdf)
+        position = base_keys.get_indexer(keys)
+        matched = position >= 0
+        rows = [(k, 'drop', None, None) for k in base_keys[~base_keys.isin(keys)]]
+
+        # Changed cells of features on both layers, columns not on the baseline are recorded where not null
+        columns = [col for col in gdf.columns if col != geom]
+        left, right = gdf.iloc[np.nonzero(matched)[0]], base.iloc[position[matched]]
+        changes = {}
+        for col in columns:
+            values = left[col].astype(object).values
+            if col in right.columns:
+                other = right[col].astype(object).values
+                same = (pd.Series(values) == pd.Series(other)).values | (pd.isna(values) & pd.isna(other))
+            else: same = pd.isna(values)
+            for i in np.nonzero(~same)[0]: changes.setdefault(i, {})[col] = _json_value(values[i])
+        if self.key is not None:
+            moved = ~left.geometry.reset_index(drop=True).geom_equals(right.geometry.reset_index(drop=True))
+            for i in np.nonzero(moved.values)[0]: changes.setdefault(i, {})
+        else: moved = pd.Series(False, index=range(len(left)))
+        matched_keys = keys[matched]
+        for i, attributes in changes.items():
+            geometry = left.geometry.iloc[i].wkb if moved.iloc[i] else None
+            rows.append((matched_keys[i], 'update', geometry, json.dumps(attributes)))
+
+        for i in np.nonzero(~matched)[0]:
+            attributes = {col: _json_value(gdf[col].iloc[i]) for col in columns}
+            g = gdf.geometry.iloc[i]
+            rows.append((keys[i], 'add', None if g is None else g.wkb, json.dumps(attributes)))
+
+        # Materialized features are the remaining baseline features followed by added ones
+        remaining = np.nonzero(base_keys.isin(keys))[0]
+        order = np.full(len(keys), -1, dtype=np.int64)
+        order[matched] = np.searchsorted(remaining, position[matched])
+        order[~matched] = len(remaining) + np.arange((~matched).sum())
+        ordering = None if np.array_equal(order, np.arange(len(order))) else order.tobytes()
+        return rows, ordering
+
+    def encode(self, experiment, gdf=None):
+        """
+        Store an experiment as deltas of the baseline, the full experiment layer is dropped from the GeoPackage
+
+        :param experiment: (str) Experiment code
+        :param gdf: (GeoDataFrame) Experiment layer, read from the GeoPackage if None
+        :return: (int) Number of delta rows
+        """
+        start_time = timeit.default_timer()
+        layer = self.layer(experiment)
+        if gdf is None: gdf = self.layers.read(layer, copy=False)
+        base = self.layers.read(self.layer(self.baseline), copy=False)
+        rows, ordering = self.diff(base, gdf)
+        columns = json.dumps([[col, str(gdf[col].dtype)] for col in gdf.columns if col != gdf.geometry.name])
+
+        con = connect(self.gpkg)
+        con.isolation_level = None
+        try:
+            con.execute('BEGIN')
+            con.execute(f'CREATE TABLE IF NOT EXISTS {SCENARIOS} (layer TEXT PRIMARY KEY, name TEXT NOT NULL, '
+                        f'experiment TEXT NOT NULL, baseline TEXT NOT NULL, key TEXT, columns TEXT, features INTEGER, '
+                        f'ordering BLOB, created TEXT NOT NULL)')
+            con.execute(f'CREATE TABLE IF NOT EXISTS {DELTAS} (layer TEXT NOT NULL, key TEXT NOT NULL, op TEXT NOT '
+                        f'NULL, geometry BLOB, attributes TEXT, PRIMARY KEY (layer, key))')
+            for table in [SCENARIOS, DELTAS]:
+                con.execute(f"INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier) "
+                            f"VALUES ('{table}', 'attributes', '{table}')")
+            LayerWriter(self.gpkg).drop(con, layer)
+            con.execute(f'DELETE FROM {DELTAS} WHERE layer = ?', (layer,))
+            con.executemany(f'INSERT INTO {DELTAS} VALUES (?, ?, ?, ?, ?)', ((layer, *row) for row in rows))
+            con.execute(f'INSERT OR REPLACE INTO {SCENARIOS} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (layer, self.name, experiment, self.layer(self.baseline), self.key, columns, len(gdf),
+                         ordering, datetime.datetime.now().isoformat()))
+            con.execute('COMMIT')
+        except:
+            if con.in_transaction: con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+        print(f"> {layer} layer stored as {len(rows)} deltas of {self.layer(self.baseline)} in {elapsed} minutes")
+        return len(rows)
+
+    def materialize(self, experiment):
+        """
+        Apply the deltas of an experiment to the baseline
+
+        :return: GeoDataFrame
+        """
+        layer = self.layer(experiment)
+        if experiment == self.baseline: return self.layers.read(layer)
+        con = sqlite3.connect(self.gpkg)
+        try:
+            meta = con.execute(f'SELECT baseline, key, columns, ordering FROM {SCENARIOS} WHERE layer = ?',
+                               (layer,)).fetchone()
+            if meta is None: raise KeyError(f"{layer} layer not stored as deltas")
+            deltas = con.execute(f'SELECT key, op, geometry, attributes FROM {DELTAS} WHERE layer = ? ORDER BY rowid',
+                                 (layer,)).fetchall()
+        finally:
+            con.close()
+        baseline, key, columns, ordering = meta
+        columns = json.loads(columns)
+
+        base = self.layers.read(baseline)
+        geom = base.geometry.name
+        base.index = ScenarioStore(self.layers, self.name, self.baseline, key).keys(base)
+        drops = [k for k, op, g, a in deltas if op == 'drop']
+        updates = [(k, g, json.loads(a)) for k, op, g, a in deltas if op == 'update']
+        adds = [(k, g, json.loads(a)) for k, op, g, a in deltas if op == 'add']
+
+        gdf = base.drop(index=drops)
+        for col, dtype in columns:
+            if col not in gdf.columns: gdf[col] = np.nan
+        values = {}
+        for k, g, attributes in updates:
+            for col, value in attributes.items(): values.setdefault(col, {})[k] = value
+        for col, cells in values.items():
+            if not pd.api.types.is_object_dtype(gdf[col]): gdf[col] = gdf[col].astype(object)
+            gdf.loc[list(cells.keys()), col] = list(cells.values())
+        moved = [(k, g) for k, g, a in updates if g is not None]
+        if len(moved) > 0:
+            gdf.loc[[k for k, g in moved], geom] = gpd.GeoSeries([wkb.loads(bytes(g)) for k, g in moved],
+                                                                 index=[k for k, g in moved], crs=base.crs)
+        if len(adds) > 0:
+            index = [k for k, g, a in adds]
+            added = pd.DataFrame([a for k, g, a in adds], index=index)
+            added[geom] = gpd.GeoSeries([None if g is None else wkb.loads(bytes(g)) for k, g, a in adds],
+                                        index=index, crs=base.crs).values
+            added = gpd.GeoDataFrame(added, geometry=geom, crs=base.crs)
+            gdf = pd.concat([gdf, added])
+        if ordering is not None: gdf = gdf.iloc[np.frombuffer(ordering, dtype=np.int64)]
+
+        gdf = gpd.GeoDataFrame(gdf[[col for col, dtype in columns] + [geom]], geometry=geom, crs=base.crs)
+        for col, dtype in columns:
+            try: gdf[col] = gdf[col].astype(dtype)
+            except (TypeError, ValueError): pass
+        return gdf.reset_index(drop=True)
+
+    def migrate(self):
+        """
+        Store every full experiment layer on the GeoPackage as deltas of the baseline
+        """
+        prefix = f"{self.name}_"
+        for layer in self.layers.list():
+            if layer.startswith(prefix) and (layer != self.layer(self.baseline)):
+                self.encode(layer[len(prefix):])
+
+        # Free the pages of the dropped layers
+        con = sqlite3.connect(self.gpkg)
+        try: con.execute('VACUUM')
+        finally: con.close()
+        return
+
+    def rebase(self, write):
+        """
+        Keep experiments valid when the baseline is modified, experiments are materialized before calling write and
+        encoded again against the new baseline
+
+        :param write: (function) Modifies the baseline layer
+        """
+        views = {experiment: self.materialize(experiment) for experiment in self.experiments()}
+        write()
+        for experiment, gdf in views.items(): self.encode(experiment, gdf)
+        return
+
+
+class Layers:
+    def __init__(self, gpkg):
+        """
+        Lazily read layers of a GeoPackage and keep them in memory until the file is modified
+
+        :param gpkg: (str) Path to the GeoPackage
+        """
+        self.gpkg = gpkg
+        self._cache = {}
+        return
+
+    def stamp(self):
+        """
+        Modification time and size of the GeoPackage (and its write-ahead log), None if the file does not exist
+        """
+        stamp = []
+        for path in [self.gpkg, f"{self.gpkg}-wal"]:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                stamp += [stat.st_mtime_ns, stat.st_size]
+        if len(stamp) == 0: return None
+        return tuple(stamp)
+
+    def list(self):
+        """
+        Layers of the GeoPackage, including experiments stored as deltas. The elab_ tables (snapshots, stages and
+        scenarios) stay registered as attribute tables, so that GDAL does not list the unregistered snapshot tables,
+        but are not layers.
+        """
+        if not os.path.exists(self.gpkg): return []
+        layers = [layer for layer in listlayers(self.gpkg) if not layer.startswith(INTERNAL)]
+        return layers + [layer for layer in scenario_index(self.gpkg).keys() if layer not in layers]
+
+    def scenarios(self, name, baseline='e0', key=None):
+        """
+        ScenarioStore of the experiment layers {name}_{experiment} of this GeoPackage
+        """
+        return ScenarioStore(self, name, baseline=baseline, key=key)
+
+    def scenario(self, layer):
+        """
+        ScenarioStore and experiment of a layer stored as deltas, the experiments based on it if the layer is a
+        baseline, (None, None) otherwise
+        """
+        index = scenario_index(self.gpkg)
+        for stored, v in index.items():
+            if layer in [stored, v['baseline']]:
+                baseline = v['baseline'][len(v['name']) + 1:]
+                store = ScenarioStore(self, v['name'], baseline=baseline, key=v['key'])
+                return store, (v['experiment'] if layer == stored else baseline)
+        return None, None
+
+    def fields(self, layer):
+        """
+        Names of the attribute fields of a layer, read from its schema
+        """
+        with fiona.open(self.gpkg, layer=layer) as src:
+            return list(src.schema['properties'].keys())
+
+    def get(self, layer, copy=True):
+        """
+        Get a layer from the cache, reading it from the GeoPackage if it was not read yet or if the file was modified
+
+        :param layer: (str) Layer name
+        :param copy: (bool) Return a copy of the cached GeoDataFrame, otherwise the cached object is shared
+        :return: GeoDataFrame
+        """
+        return self.read(layer, copy=copy)
+
+    def read(self, layer, bbox=None, mask=None, columns=None, copy=True, fids=False):
+        """
+        Read a layer pushing spatial and attribute filters down to the driver, so that only features within the bbox or
+        mask and only the listed columns are loaded. Filtered reads are cached separately from full layers.
+
+        :param layer: (str) Layer name
+        :param bbox: (tuple, GeoDataFrame or GeoSeries) Bounding box to filter features
+        :param mask: (Polygon, GeoDataFrame or GeoSeries) Geometry to filter features that intersects it
+        :param columns: (list) Columns to read (case insensitive), geometry is always read
+        :param copy: (bool) Return a copy of the cached GeoDataFrame, otherwise the cached object is shared
+        :param fids: (bool) Add a fid column with the feature ids of the layer (positions for experiments stored as
+        deltas), so that rows can be upserted back after they are filtered or reordered
+        :return: GeoDataFrame
+        """
+
+        if fids and any(arg is not None for arg in [bbox, mask, columns]):
+            raise ValueError("Feature ids are only read with whole layers")
+        if isinstance(bbox, (gpd.GeoDataFrame, gpd.GeoSeries)): bbox_key = (tuple(bbox.total_bounds), str(bbox.crs))
+        else: bbox_key = bbox
+        if isinstance(mask, (gpd.GeoDataFrame, gpd.GeoSeries)): mask_key = (mask.unary_union.wkb, str(mask.crs))
+        elif mask is not None: mask_key = mask.wkb
+        else: mask_key = None
+        key = layer if all(arg is None for arg in [bbox, mask, columns]) else \
+            (layer, bbox_key, mask_key, None if columns is None else tuple(columns))
+
+        stamp = self.stamp()
+        missing = (key not in self._cache) or (self._cache[key][0] != stamp)
+        store, experiment = self.scenario(layer) if missing else (None, None)
+        if (store is not None) and (experiment != store.baseline):
+            # Experiments stored as deltas are materialized and filtered in memory
+            gdf = store.materialize(experiment)
+            if bbox is not None:
+                minx, miny, maxx, maxy = bbox.total_bounds if isinstance(bbox, (gpd.GeoDataFrame, gpd.GeoSeries)) \
+                    else bbox
+                gdf = gdf.cx[minx:maxx, miny:maxy]
+            if mask is not None:
+                gdf = gdf[gdf.intersects(mask.unary_union if isinstance(mask, (gpd.GeoDataFrame, gpd.GeoSeries))
+                                         else mask)]
+            if columns is not None:
+                wanted = [col.lower() for col in columns]
+                gdf = gdf[[col for col in gdf.columns if (col.lower() in wanted) or (col == gdf.geometry.name)]]
+            self._cache[key] = (stamp, gdf)
+            print(f"> {len(gdf)} features of {layer} layer materialized from {store.layer(store.baseline)} deltas")
+        elif missing:
+            kwargs = {}
+            if bbox is not None: kwargs['bbox'] = bbox
+            if mask is not None: kwargs['mask'] = mask
+            if columns is not None:
+                wanted = [col.lower() for col in columns]
+                fields = self.fields(layer)
+                keep = [f for f in fields if f.lower() in wanted]
+                ignore = [f for f in fields if f not in keep]
+                try: gdf = gpd.read_file(self.gpkg, layer=layer, ignore_fields=ignore, **kwargs)
+                except TypeError: gdf = gpd.read_file(self.gpkg, layer=layer, columns=keep, **kwargs)
+            else: gdf = gpd.read_file(self.gpkg, layer=layer, **kwargs)
+            self._cache[key] = (stamp, gdf)
+            print(f"> {len(gdf)} features of {layer} layer read from {os.path.basename(self.gpkg)}")
+        if fids:
+            gdf = self._cache[key][1].copy()
+            store, experiment = self.scenario(layer)
+            if (store is not None) and (experiment != store.baseline): gdf[FID] = np.arange(len(gdf))
+            else: gdf[FID] = layer_fids(self.gpkg, layer)
+            return gdf
+        if copy: return self._cache[key][1].copy()
+        else: return self._cache[key][1]
+
+    def write(self, layer, gdf, **kwargs):
+        """
+        Write a layer to the GeoPackage and refresh the cache, layers cached before the write remain valid
+        """
+        before = self.stamp()
+        store, experiment = self.scenario(layer)
+        if store is None: gdf.to_file(self.gpkg, layer=layer, driver='GPKG', **kwargs)
+        elif experiment != store.baseline: store.encode(experiment, gdf)
+        else: store.rebase(lambda: gdf.to_file(self.gpkg, layer=layer, driver='GPKG', **kwargs))
+        self.refresh(before, {layer: gdf})
+        return
+
+    def writer(self):
+        """
+        LayerWriter that writes several layers in one transaction and refreshes this cache
+        """
+        return LayerWriter(self.gpkg, cache=self)
+
+    def drop(self, layers):
+        """
+        Drop layers, their spatial indexes and metadata from the GeoPackage in one transaction, cached copies of the
+        layers are dropped
+
+        :param layers: (list) Layer names
+        """
+        if len(layers) == 0: return
+        before = self.stamp()
+        con = connect(self.gpkg)
+        con.isolation_level = None
+        try:
+            con.execute('BEGIN')
+            for layer in layers: LayerWriter(self.gpkg).drop(con, layer)
+            con.execute('COMMIT')
+        except:
+            if con.in_transaction: con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        self.refresh(before, {})
+        for layer in layers: self.invalidate(layer)
+        print(f"> {len(layers)} layers dropped from {os.path.basename(self.gpkg)}")
+        return
+
+    def upsert(self, layer, df, columns=None):
+        """
+        Add or update columns of a layer in place (see upsert_columns), cached copies of the layer are dropped
+        """
+        before = self.stamp()
+        store, experiment = self.scenario(layer)
+        if store is None: upsert_columns(self.gpkg, layer, df, columns)
+        elif experiment != store.baseline:
+            gdf = store.materialize(experiment)
+            if FID in df.columns: rows = gdf.index[df[FID].astype(int).values]
+            elif len(df) == len(gdf): rows = gdf.index
+            else: raise ValueError(f"{len(df)} rows can not be matched to the {len(gdf)} features of {layer} without "
+                                   f"a {FID} column, read the layer with Layers.read(layer, fids=True)")
+            for col in ([c for c in df.columns if c not in ['geometry', FID]] if columns is None else columns):
+                gdf.loc[rows, col] = df[col].values
+            store.encode(experiment, gdf)
+        else: store.rebase(lambda: upsert_columns(self.gpkg, layer, df, columns))
+        self.refresh(before, {})
+        self.invalidate(layer)
+        return
+
+    @property
+    def archive(self):
+        """
+        Path to the sidecar archive of layer snapshots
+        """
+        return f"{os.path.splitext(self.gpkg)[0]}.snapshots.sqlite"
+
+    def snapshot(self, layer, sidecar=True, keep=3, days=None):
+        """
+        Snapshot a layer before it is overwritten (see snapshot_layer), cached layers remain valid
+
+        :param sidecar: (bool) Keep the snapshot in the sidecar archive, otherwise inside the GeoPackage
+        """
+        before = self.stamp()
+        snapshot = snapshot_layer(self.gpkg, layer, archive=self.archive if sidecar else None, keep=keep, days=days)
+        self.refresh(before, {})
+        return snapshot
+
+    def restore(self, layer, version=None, sidecar=True):
+        """
+        Restore a layer from a snapshot (see restore_layer), cached copies of the layer are dropped
+        """
+        before = self.stamp()
+        snapshot = restore_layer(self.gpkg, layer, version=version, archive=self.archive if sidecar else None)
+        self.refresh(before, {})
+        self.invalidate(layer)
+        return snapshot
+
+    def stage(self, stage):
+        return stage_digest(self.gpkg, stage)
+
+    def last_changes(self, layers):
+        return last_changes(self.gpkg, layers)
+
+    def record_stage(self, stage, digest):
+        before = self.stamp()
+        record_stage(self.gpkg, stage, digest)
+        self.refresh(before, {})
+        return
+
+    def refresh(self, before, written):
+        """
+        Keep cached layers after writing to the GeoPackage, layers that were written are replaced and the others are
+        kept only if the file was not modified by anything else since they were cached
+
+        :param before: Stamp of the file before writing
+        :param written: (dict) Layer names and GeoDataFrames written
+        """
+        stamp = self.stamp()
+        for key, (cached, gdf) in list(self._cache.items()):
+            layer = key[0] if isinstance(key, tuple) else key
+            if (cached == before) and (layer not in written): self._cache[key] = (stamp, gdf)
+            else: del self._cache[key]
+        for layer, gdf in written.items():
+            self._cache[layer] = (stamp, gdf.copy())
+        return
+
+    def invalidate(self, layer=None):
+        if layer is None: self._cache = {}
+        else:
+            for key in list(self._cache.keys()):
+                if (key == layer) or (isinstance(key, tuple) and key[0] == layer): del self._cache[key]
+        return
+
+    def __getitem__(self, layer):
+        return self.get(layer)
+
+    def __setitem__(self, layer, gdf):
+        self.write(layer, gdf)
+
+    def __contains__(self, layer):
+        return layer in self.list()
@@ -0,0 +1,217 @@
+"""
+MIT License
+
+Copyright (c) 2020 Nicholas Martino
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+from matplotlib.path import Path
+from shapely.geometry.polygon import orient
+
+
+def polygon_paths(geometries):
+    """
+    Matplotlib paths of polygons, one compound path (with holes) per feature and empty paths for missing geometries
+
+    :param geometries: (GeoSeries) Polygons or MultiPolygons
+    :return: (list) Paths
+    """
+    paths = []
+    for geom in geometries:
+        vertices, codes = [], []
+        if (geom is not None) and (not geom.is_empty):
+            parts = list(geom.geoms) if hasattr(geom, 'geoms') else [geom]
+            for part in parts:
+                if part.geom_type != 'Polygon': continue
+                # Exteriors counter-clockwise and interiors clockwise, so that holes are not filled
+                part = orient(part, sign=1.0)
+                for ring in [part.exterior] + list(part.interiors):
+                    xy = np.asarray(ring.coords)[:, :2]
+                    code = np.full(len(xy), Path.LINETO, dtype=Path.code_type)
+                    code[0], code[-1] = Path.MOVETO, Path.CLOSEPOLY
+                    vertices.append(xy)
+                    codes.append(code)
+        if len(vertices) > 0: paths.append(Path(np.concatenate(vertices), np.concatenate(codes)))
+        else: paths.append(Path(np.zeros((1, 2)), [Path.MOVETO]))
+    return paths
+
+
+class Maps:
+    def __init__(self, geometries, nrows, ncols, figsize=(10, 12), colorbar='panel', label=None):
+        """
+        Grid of map panels of one set of polygons, drawn without a display (Agg). Polygons are converted to paths once
+        and each panel draws them with its own collection, so mapping new values only updates colour arrays and norms.
+        The figure can be saved several times with different values.
+
+        :param geometries: (GeoSeries or GeoDataFrame) Polygons
+        :param nrows: (int) Number of rows of panels
+        :param ncols: (int) Number of columns of panels
+        :param figsize: (tuple) Size of the figure in inches
+        :param colorbar: (str) 'panel' for one colour bar per panel, 'row' for one per row, None for no colour bars
+        :param label: (str) Label of the colour bars
+        """
+        if hasattr(geometries, 'geometry'): geometries = geometries.geometry
+        self.paths = polygon_paths(geometries)
+        minx, miny, maxx, maxy = geometries.total_bounds
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.subplots(nrows, ncols, squeeze=False)
+        self.collections = {}
+        self.colorbars = {}
+
+        for i in range(nrows):
+            for j in range(ncols):
+                ax = self.axes[i][j]
+                collection = PathCollection(self.paths, transform=ax.transData, linewidths=0)
+                collection.set_array(np.ma.masked_all(len(self.paths)))
+                collection.set_norm(Normalize(0, 1))
+                ax.add_collection(collection, autolim=False)
+                ax.set_xlim(minx, maxx)
+                ax.set_ylim(miny, maxy)
+                ax.set_aspect('equal')
+                ax.set_axis_off()
+                self.collections[(i, j)] = collection
+                if colorbar == 'panel': self.colorbars[(i, j)] = self.figure.colorbar(collection, ax=ax)
+            if colorbar == 'row':
+                self.colorbars[i] = self.figure.colorbar(self.collections[(i, ncols - 1)], ax=list(self.axes[i]))
+        if label is not None:
+            for cb in self.colorbars.values(): cb.set_label(label)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def panel(self, row, col, values, cmap='viridis', vmin=None, vmax=None, title=None):
+        """
+        Map values (one per polygon, missing values are not drawn) on one panel
+
+        :param vmin: (float) Lower limit of the colour map, the minimum of values if None
+        :param vmax: (float) Upper limit of the colour map, the maximum of values if None
+        """
+        values = np.ma.masked_invalid(np.asarray(values, dtype=float))
+        norm = Normalize(vmin=vmin, vmax=vmax)
+        norm.autoscale_None(values)
+        collection = self.collections[(row, col)]
+        collection.set_array(values)
+        collection.set_cmap(cmap)
+        collection.set_norm(norm)
+        self.axes[row][col].set_title('' if title is None else title)
+        # Colour bars of rows follow the last panel mapped on the row
+        for key in [(row, col), row]:
+            if key in self.colorbars:
+                self.colorbars[key].ax.set_visible(True)
+                self.colorbars[key].update_normal(collection)
+        return
+
+    def clear(self, row, col):
+        """
+        Leave a panel blank
+        """
+        self.collections[(row, col)].set_array(np.ma.masked_all(len(self.paths)))
+        self.axes[row][col].set_title('')
+        if (row, col) in self.colorbars: self.colorbars[(row, col)].ax.set_visible(False)
+        return
+
+    def save(self, path, dpi=None):
+        self.figure.savefig(path, dpi=dpi)
+        return
+
+    def close(self):
+        self.figure.clear()
+        self.collections = {}
+        self.colorbars = {}
+        return
+
+
+# Geometries and figures of each worker process, figures are reused by pages with the same layout
+_GEOMETRIES = {}
+_MAPS = {}
+
+
+def _initialize(geometries):
+    _GEOMETRIES.update(geometries)
+    # Figures are closed when the worker shuts down (atexit handlers are not run by pool workers)
+    Finalize(None, close_maps, exitpriority=10)
+    return
+
+
+def close_maps():
+    """
+    Close the figures reused by render and release the geometries of this process
+    """
+    for maps in _MAPS.values(): maps.close()
+    _MAPS.clear()
+    _GEOMETRIES.clear()
+    return
+
+
+def render(page):
+    """
+    Render one page of map panels
+
+    :param page: (dict) 'layer' (name of the geometries), 'path' (output file), 'nrows', 'ncols' and 'panels' (list of
+    keyword arguments of Maps.panel), optionally 'figsize', 'colorbar' and 'label'. Panels not listed are blank.
+    :return: (str) Path of the page
+    """
+    key = (page['layer'], page['nrows'], page['ncols'], tuple(page.get('figsize', (10, 12))),
+           page.get('colorbar', 'panel'), page.get('label'))
+    if key not in _MAPS:
+        _MAPS[key] = Maps(_GEOMETRIES[page['layer']], page['nrows'], page['ncols'], figsize=key[3],
+                          colorbar=key[4], label=key[5])
+    maps = _MAPS[key]
+    drawn = set()
+    for panel in page['panels']:
+        maps.panel(**panel)
+        drawn.add((panel['row'], panel['col']))
+    for row, col in sorted(set(maps.collections.keys()) - drawn): maps.clear(row, col)
+    maps.save(page['path'])
+    return page['path']
+
+
+def render_pages(geometries, pages, workers=None):
+    """
+    Render pages of map panels across a pool of processes, geometries are sent once to each worker
+
+    :param geometries: (dict) Layer names and their GeoSeries (or GeoDataFrames)
+    :param pages: (list) Pages (see render)
+    :param workers: (int) Number of processes, the number of processors if None
+    :return: (list) Paths of the pages
+    """
+    start_time = timeit.default_timer()
+    geometries = {layer: gdf.geometry if hasattr(gdf, 'geometry') else gdf for layer, gdf in geometries.items()}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initialize, initargs=(geometries,)) as executor:
+        paths = list(executor.map(render, pages))
+    elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+    print(f"> {len(paths)} map pages rendered in {elapsed} minutes")
+    return paths
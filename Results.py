@@ -0,0 +1,198 @@
+"""
+MIT License
+
+Copyright (c) 2020 Nicholas Martino
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import json
+import os
+import warnings
+
+import geopandas as gpd
+import numpy as np
+
+
+AXES = ['experiment', 'seed', 'infra', 'mode', 'feature']
+COMPLETE = 'complete.json'
+
+
+class ResultsCube:
+    def __init__(self, path, mode='r'):
+        """
+        Results of experiments, random seeds, infrastructure scenarios and modes for features that share one geometry
+        table. A cube is a directory with the values (values.npy, memory-mapped so that slices are read from disk only
+        when used), the labels of each axis (labels.json), the geometry of the features (geometry.gpkg) and, once every
+        value was written, a completion marker with the digest of the inputs of the results (complete.json).
+
+        :param path: (str) Directory of the cube
+        :param mode: (str) 'r' to read values, 'r+' to update them
+        """
+        self.path = path
+        with open(f'{path}/labels.json') as file: self.labels = json.load(file)
+        self.values = np.load(f'{path}/values.npy', mmap_mode=mode)
+        self._geometry = None
+        return
+
+    @classmethod
+    def create(cls, path, geometry, experiments, seeds, infras, modes, dtype='float32'):
+        """
+        Create an empty cube (filled with NaN) for the features of a GeoDataFrame
+
+        :return: ResultsCube opened to update values
+        """
+        if not os.path.exists(path): os.makedirs(path)
+        if os.path.exists(f'{path}/{COMPLETE}'): os.remove(f'{path}/{COMPLETE}')
+        features = gpd.GeoDataFrame(geometry=geometry.geometry.values, crs=geometry.crs)
+        features.to_file(f'{path}/geometry.gpkg', layer='features', driver='GPKG')
+        labels = {'experiment': list(experiments), 'seed': [int(s) for s in seeds], 'infra': list(infras),
+                  'mode': list(modes), 'feature': list(range(len(features)))}
+        with open(f'{path}/labels.json', 'w') as file: json.dump(labels, file)
+        values = np.lib.format.open_memmap(f'{path}/values.npy', mode='w+', dtype=dtype,
+                                           shape=tuple(len(labels[axis]) for axis in AXES))
+        values[:] = np.nan
+        values.flush()
+        del values
+        print(f"> Results cube with shape {tuple(len(labels[axis]) for axis in AXES)} created at {path}")
+        return cls(path, mode='r+')
+
+    @staticmethod
+    def is_complete(path, digest=None):
+        """
+        Whether a cube was completely written, from inputs with the digest if not None
+        """
+        if not os.path.exists(f'{path}/{COMPLETE}'): return False
+        if digest is None: return True
+        with open(f'{path}/{COMPLETE}') as file: return json.load(file).get('digest') == digest
+
+    def complete(self, digest=None):
+        """
+        Flush the values and mark the cube as completely written from inputs with the digest, the marker is written
+        last so that interrupted runs leave incomplete cubes
+        """
+        self.flush()
+        with open(f'{self.path}/{COMPLETE}.tmp', 'w') as file: json.dump({'digest': digest}, file)
+        os.replace(f'{self.path}/{COMPLETE}.tmp', f'{self.path}/{COMPLETE}')
+        return
+
+    @property
+    def geometry(self):
+        if self._geometry is None: self._geometry = gpd.read_file(f'{self.path}/geometry.gpkg', layer='features')
+        return self._geometry
+
+    def axes(self, **labels):
+        """
+        Axes kept by a selection, axes selected with a single label are dropped
+        """
+        return [axis for axis in AXES if isinstance(labels.get(axis), (list, tuple, range, type(None)))]
+
+    def positions(self, axis, labels=None):
+        if labels is None: return slice(None)
+        if isinstance(labels, (list, tuple, range)): return [self.labels[axis].index(label) for label in labels]
+        return self.labels[axis].index(labels)
+
+    def sel(self, **labels):
+        """
+        Slice values by labels of each axis, ex: cube.sel(infra='bus', mode=['walk', 'bike']) returns an array with
+        the axes (experiment, seed, mode, feature). Selections of single labels are views of the file on disk.
+        """
+        keys = [self.positions(axis, labels.get(axis)) for axis in AXES]
+        array = self.values[tuple(slice(None) if isinstance(key, list) else key for key in keys)]
+        kept = [key for key in keys if not isinstance(key, int)]
+        for i, key in enumerate(kept):
+            if isinstance(key, list): array = np.take(array, key, axis=i)
+        return array
+
+    def write(self, values, **labels):
+        """
+        Update the values of a selection, ex: cube.write(shares, experiment='E1', seed=0, infra='bus', mode='walk')
+        """
+        keys = [self.positions(axis, labels.get(axis)) for axis in AXES]
+        if any(isinstance(key, list) for key in keys): raise ValueError("Values are written to single labels or axes")
+        self.values[tuple(keys)] = values
+        return
+
+    def writer(self, seeds, **labels):
+        """
+        CubeWriter that stores replicates in the order of seeds (see Sandbox.replicate)
+        """
+        return CubeWriter(self, seeds, **labels)
+
+    def mean(self, axis='seed', **labels):
+        """
+        Mean of a selection along one of its axes, missing values are skipped
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmean(self.sel(**labels), axis=self.axes(**labels).index(axis))
+
+    def delta(self, baseline='E0', relative=True, **labels):
+        """
+        Difference of every experiment from the baseline experiment (%, if relative), keeps the axes of sel
+        """
+        if 'experiment' in labels: raise ValueError("Deltas are calculated for every experiment")
+        array = self.sel(**labels).astype(float)
+        base = np.expand_dims(self.sel(experiment=baseline, **labels).astype(float), axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return ((array - base) / base) * 100 if relative else array - base
+
+    def frame(self, columns):
+        """
+        GeoDataFrame of the features with columns of values
+
+        :param columns: (dict) Column names and arrays with one value per feature
+        """
+        gdf = self.geometry.copy()
+        for name, values in columns.items(): gdf[name] = values
+        return gdf
+
+    def flush(self):
+        if isinstance(self.values, np.memmap): self.values.flush()
+        return
+
+
+class CubeWriter:
+    def __init__(self, cube, seeds, **labels):
+        """
+        Write each replicate to the cube as it is summarized, replicates are DataFrames with one row per feature and
+        (experiment, mode) columns
+
+        :param cube: (ResultsCube) Cube opened to update values
+        :param seeds: (list) Seed labels of the replicates, in the order they are summarized
+        :param labels: Labels of the other axes, ex: infra='bus'
+        """
+        self.cube = cube
+        self.seeds = list(seeds)
+        self.labels = labels
+        self.replicates = 0
+        return
+
+    @property
+    def done(self):
+        return self.replicates == len(self.seeds)
+
+    def update(self, df):
+        seed = self.seeds[self.replicates]
+        for (experiment, mode) in df.columns:
+            self.cube.write(df[(experiment, mode)].values, experiment=experiment, seed=seed, mode=mode, **self.labels)
+        self.cube.flush()
+        self.replicates += 1
+        return
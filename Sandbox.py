@@ -1,32 +1,67 @@
+import hashlib
+import os
+import timeit
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+from Analyst import query_bulk
 from shapely.geometry import Point
-from skbio import diversity
 
 
-def proxy_indicators(local_gbd, district_gbd, experiment, max_na_radius=4800):
+DISTRICT_LAYERS = ['network_nodes', 'network_axial', 'network_drive', 'network_stops']
 
-    exp = list(experiment.keys())[0]
-    yr = list(experiment.values())[0]
 
-    loc_bdr = gpd.read_file(local_gbd.gpkg, layer='land_municipal_boundary')
+def proxy_district(local_gbd, district_gbd, max_na_radius=4800):
+    """
+    Transfer district-wide layers within the buffered boundary of the sandbox. Outputs do not depend on experiments,
+    so the stage is skipped while the district GeoPackage, the sandbox boundary and the radius do not change and the
+    outputs were not modified since (i.e. by node_elevation).
+
+    :param local_gbd: class GeoBoundary of the sandbox
+    :param district_gbd: class GeoBoundary of the district
+    :param max_na_radius: (float) Largest radius of network analysis around the sandbox boundary
+    """
+
+    loc_bdr = local_gbd.layers['land_municipal_boundary']
     loc_bdr = loc_bdr.to_crs(local_gbd.crs)
     loc_bdr_b = gpd.GeoDataFrame(geometry=loc_bdr.buffer(max_na_radius))
 
+    inputs = [district_gbd.gpkg, district_gbd.layers.stamp(), loc_bdr.unary_union.wkb.hex(), max_na_radius,
+              local_gbd.crs, DISTRICT_LAYERS]
+    # The digest covers the last change of the outputs, so outputs modified after the stage are written again
+    stage_key = lambda: hashlib.sha256(
+        repr(inputs + [local_gbd.layers.last_changes(DISTRICT_LAYERS)]).encode('utf-8')).hexdigest()
+    if (local_gbd.layers.stage('proxy_district') == stage_key()) and \
+            all(l in local_gbd.layers for l in DISTRICT_LAYERS):
+        print("\n> District-wide layers up to date, union skipped")
+        return local_gbd
+
     print("\n> Performing simple union for district-wide layers")
-    def rd_repr_ovr_exp(left_gpkg, right_gpkg, layer, crs):
-        gdf = gpd.read_file(left_gpkg, layer=layer)
-        try: gdf.to_crs(crs)
-        except: gdf.crs = crs
-        ovr = gpd.overlay(gdf, loc_bdr_b)
-        ovr.to_file(right_gpkg, layer=layer)
-    for lyr in ['network_nodes', 'network_axial', 'network_drive', 'network_stops']:
-        rd_repr_ovr_exp(district_gbd.gpkg, local_gbd.gpkg, layer=lyr, crs=local_gbd.crs)
+    with local_gbd.layers.writer() as writer:
+        for layer in DISTRICT_LAYERS:
+            # Only features within the buffered boundary are read from the district GeoPackage
+            gdf = district_gbd.layers.read(layer, mask=loc_bdr_b)
+            try: gdf.to_crs(local_gbd.crs)
+            except: gdf.crs = local_gbd.crs
+            writer[layer] = gpd.overlay(gdf, loc_bdr_b)
+    local_gbd.layers.record_stage('proxy_district', stage_key())
+    return local_gbd
+
+
+def proxy_indicators(local_gbd, district_gbd, experiment, max_na_radius=4800):
+
+    exp = list(experiment.keys())[0]
+    yr = list(experiment.values())[0]
+
+    # Experiment-invariant stage
+    proxy_district(local_gbd, district_gbd, max_na_radius=max_na_radius)
 
     print("> Joining attributes from buildings to parcels")
-    buildings = gpd.read_file(local_gbd.gpkg, layer=f'fabric_buildings_{exp}')
-    parcels2 = gpd.read_file(local_gbd.gpkg, layer=f'land_parcels_{exp}')
+    buildings = local_gbd.layers[f'fabric_buildings_{exp}']
+    parcels2 = local_gbd.layers[f'land_parcels_{exp}']
     parcels2['OBJECTID'] = [i for i in range(len(parcels2))]
 
     if 'OBJECTID' not in parcels2.columns:
@@ -34,60 +69,51 @@ def proxy_indicators(local_gbd, district_gbd, experiment, max_na_radius=4800):
 
     # Join data from buildings to parcels
     pcl_bdg_raw = gpd.sjoin(parcels2, buildings, how='left', lsuffix="pcl", rsuffix="bdg")
-    col2try = ["OBJECTID_pcl", "OBJECTID"]
-    pcl_bdg = None
-    while True:
-        for col in col2try:
-            try:
-                pcl_bdg = pcl_bdg_raw.groupby(col)
-                break
-            except: pass
-        break
-
-    if pcl_bdg is None:
+
+    # Resolve column names that vary between datasets (suffixed when present on both layers)
+    def resolve(*names):
+        for name in names:
+            if name in pcl_bdg_raw.columns: return name
+        return None
+    group_col = resolve("OBJECTID_pcl", "OBJECTID")
+    if group_col is None:
         print("!!! Grouped by parcel not defined !!!")
 
+    # Aggregate every parcel attribute from its buildings in a single pass
+    aggregations = {
+        'population': (resolve('res_count', 'res_count_bdg'), 'sum'),
+        'dwellings': (resolve('n_res_unit', 'res_units_bdg'), 'sum'),
+        'floor_area': (resolve('floor_area', 'floor_area_bdg'), 'sum'),
+        'footprint': (resolve('ftprt_area', 'Shape_Area_bdg'), 'sum'),
+        'stories': (resolve('maxstories', 'maxstories_bdg'), 'mean'),
+        'bedrooms': (resolve('n_bedrms', 'n_bedrms_bdg', 'num_bedrms_bdg'), 'sum'),
+        'land_use': (resolve('Landuse_pcl', 'LANDUSE_pcl', 'Landuse', 'LANDUSE'), 'first'),
+    }
+    pcl_bdg = pcl_bdg_raw.groupby(group_col).agg(**{
+        name: pd.NamedAgg(column=col, aggfunc=func) for name, (col, func) in aggregations.items() if col is not None})
+
     parcels2['area'] = parcels2['geometry'].area
     parcels2["area_sqkm"] = parcels2['area'] / 1000000
-    try:
-        res_count_col = 'res_count'
-        parcels2["population, 2016"] = pcl_bdg.sum()[res_count_col].values
-    except:
-        res_count_col = 'res_count_bdg'
-        parcels2["population, 2016"] = pcl_bdg.sum()[res_count_col].values
+    parcels2["population, 2016"] = pcl_bdg['population'].values
     print(f"{exp} experiment with {parcels2['population, 2016'].sum()} people")
-    parcels2.to_file(local_gbd.gpkg, layer=f"land_parcels_{exp}", driver='GPKG')
+    local_gbd.layers[f"land_parcels_{exp}"] = parcels2
 
     print("> Adapting parcels to dissemination area")
     dss_are = parcels2
-    try: dss_are["population, 2016"] = pcl_bdg.sum()[res_count_col].values
-    except: dss_are["population, 2016"] = pcl_bdg.sum()[res_count_col].values
-    dss_are["population density per square kilometre, 2016"] = pcl_bdg.sum()[res_count_col].values / parcels2['Shape_Area']
-    try: dss_are["n_dwellings"] = pcl_bdg.sum()['n_res_unit'].values
-    except: dss_are["n_dwellings"] = pcl_bdg.sum()['res_units_bdg'].values
+    dss_are["population, 2016"] = pcl_bdg['population'].values
+    dss_are["population density per square kilometre, 2016"] = pcl_bdg['population'].values / parcels2['Shape_Area']
+    dss_are["n_dwellings"] = pcl_bdg['dwellings'].values
 
     print("> Adapting parcels to assessment fabric")
     ass_fab = parcels2
-    try: ass_fab["n_use"] = [u[0] for u in pcl_bdg['Landuse_pcl'].unique()]
-    except: ass_fab["n_use"] = [u[0] for u in pcl_bdg['LANDUSE_pcl'].unique()]
+    ass_fab["n_use"] = pcl_bdg['land_use'].values
     ass_fab.loc[:, 'area'] = parcels2.loc[:, 'geometry'].area
-    ass_fab.loc[parcels2['area'] < 400, 'n_size'] = 'less than 400'
-    ass_fab.loc[(parcels2['area'] > 400) & (parcels2['area'] < 800), 'n_size'] = '400 to 800'
-    ass_fab.loc[(parcels2['area'] > 800) & (parcels2['area'] < 1600), 'n_size'] = '800 to 1600'
-    ass_fab.loc[(parcels2['area'] > 1600) & (parcels2['area'] < 3200), 'n_size'] = '1600 to 3200'
-    ass_fab.loc[(parcels2['area'] > 3200) & (parcels2['area'] < 6400), 'n_size'] = '3200 to 6400'
-    ass_fab.loc[parcels2['area'] > 6400, 'n_size'] = 'more than 6400'
-    try: ass_fab["total_finished_area"] = (pcl_bdg.sum()['floor_area'] * pcl_bdg.mean()['maxstories']).values
-    except: ass_fab["total_finished_area"] = (pcl_bdg.sum()['floor_area_bdg'] * pcl_bdg.mean()['maxstories']).values
-    try: ass_fab["gross_building_area"] = (pcl_bdg.sum()['ftprt_area'] * pcl_bdg.mean()['maxstories']).values
-    except: ass_fab["gross_building_area"] = (pcl_bdg.sum()['Shape_Area_bdg'] * pcl_bdg.mean()['maxstories']).values
-    try:
-        for n_bedrms_col in ['n_bedrms', 'n_bedrms_bdg', 'num_bedrms_bdg']:
-            try:
-                ass_fab["number_of_bedrooms"] = pcl_bdg.sum()[n_bedrms_col].values
-                break
-            except: pass
-    except: pass
+    ass_fab['n_size'] = pd.cut(parcels2['area'], bins=[0, 400, 800, 1600, 3200, 6400, np.inf], right=False, labels=[
+        'less than 400', '400 to 800', '800 to 1600', '1600 to 3200', '3200 to 6400', 'more than 6400']).astype(str)
+    ass_fab["total_finished_area"] = (pcl_bdg['floor_area'] * pcl_bdg['stories']).values
+    ass_fab["gross_building_area"] = (pcl_bdg['footprint'] * pcl_bdg['stories']).values
+    if 'bedrooms' in pcl_bdg.columns:
+        ass_fab["number_of_bedrooms"] = pcl_bdg['bedrooms'].values
 
     print("> Calculating diversity indices")
 
@@ -109,7 +135,7 @@ def proxy_indicators(local_gbd, district_gbd, experiment, max_na_radius=4800):
     # dss_are["dwelling_div_rooms_si"] = [diversity.alpha_diversity("simpson", df_ddr)[0] for i in range(len(dss_are))]
     # dss_are["dwelling_div_rooms_sh"] = [diversity.alpha_diversity("shannon", df_ddr)[0] for i in range(len(dss_are))]
 
-    init_streets = gpd.read_file(local_gbd.gpkg, layer='network_links')
+    init_streets = local_gbd.layers['network_links']
     streets = init_streets
     streets["length"] = streets.geometry.length
     cycling = streets[streets[f"cycle_{yr}"] == 1]
@@ -120,32 +146,38 @@ def proxy_indicators(local_gbd, district_gbd, experiment, max_na_radius=4800):
         'geometry': [Point(geom.coords[0]) for geom in streets.geometry]
     }, geometry='geometry')
     stops = stops.drop_duplicates(subset=['geometry']).reset_index(drop=True)
-    bus2020 = streets[streets['bus_2020'] == 1].geometry.buffer(5).unary_union
-    freqt2040 = streets[streets['freqt_2040'] == 1].geometry.buffer(5).unary_union
-    rapid2040 = streets[streets['rapid_2040'] == 1].geometry.buffer(5).unary_union
-    for i in list(stops.index):
-        if stops.iloc[i]['geometry'].within(bus2020):
-            stops.at[i, 'frequency'] = 32  # 1.3 trips per hour
-            stops.at[i, 'frequency_2020'] = 32  # 1.3 trips per hour
-            stops.at[i, 'frequency_2040'] = 32  # 1.3 trips per hour
-        if stops.iloc[i]['geometry'].within(rapid2040):
-            stops.at[i, 'frequency'] = 48 # 2 trips per hour
-            stops.at[i, 'frequency_2040'] = 48 # 2 trips per hour
-        if stops.iloc[i]['geometry'].within(freqt2040) & yr == 2040:
-            stops.at[i, 'frequency'] = 192 # 8 trips per hour
-            stops.at[i, 'frequency_2040'] = 192 # 8 trips per hour
+
+    # Frequencies (trips per day) of stops within 5 m of segments flagged for each service, rows further down the
+    # table take priority over the ones above and missing values keep the frequency of the previous services
+    priority = pd.DataFrame([
+        ['bus_2020', True, 32, 32, 32],  # 1.3 trips per hour
+        ['rapid_2040', True, 48, np.nan, 48],  # 2 trips per hour
+        ['freqt_2040', yr == 2040, 192, np.nan, 192],  # 8 trips per hour
+    ], columns=['flag', 'active', 'frequency', 'frequency_2020', 'frequency_2040'])
+    priority = priority[priority['active']].reset_index(drop=True)
+    flags = list(priority['flag'])
+    flagged = streets[(streets[flags] == 1).any(axis=1)]
+    segment, stop = query_bulk(stops, flagged.geometry.buffer(5), predicate='intersects')
+    hits = pd.DataFrame(flagged[flags].values[segment] == 1, columns=priority.index)
+    hits['stop'] = stop
+    hits = hits.melt(id_vars='stop', var_name='level', value_name='hit')
+    hits = hits[hits['hit']].merge(priority, left_on='level', right_index=True).sort_values('level')
+    columns = ['frequency', 'frequency_2020', 'frequency_2040']
+    stops[columns] = hits.groupby('stop')[columns].last().reindex(stops.index)
     stops = stops.fillna(0)
     stops = stops[stops['frequency'] > 0]
 
     if len(streets) < len(init_streets):
         print("!!! Streets line count smaller than initial !!!")
 
-    stops.to_file(local_gbd.gpkg, layer='network_stops', encoding='ISO-8859-1')
-    streets.to_file(local_gbd.gpkg, layer='network_links', encoding='ISO-8859-1')
-    cycling.to_file(local_gbd.gpkg, layer='network_cycle', encoding='ISO-8859-1')
-    ass_fab.to_file(local_gbd.gpkg, layer='land_assessment_fabric', encoding='ISO-8859-1')
-    parcels2.to_file(local_gbd.gpkg, layer='land_assessment_parcels', encoding='ISO-8859-1')
-    dss_are.to_file(local_gbd.gpkg, layer='land_dissemination_area', encoding='ISO-8859-1')
+    # Write all layers of the experiment in one transaction
+    with local_gbd.layers.writer() as writer:
+        writer['network_stops'] = stops
+        writer['network_links'] = streets
+        writer['network_cycle'] = cycling
+        writer['land_assessment_fabric'] = ass_fab
+        writer['land_assessment_parcels'] = parcels2
+        writer['land_dissemination_area'] = dss_are
 
     return local_gbd
 
@@ -158,67 +190,257 @@ def proxy_network(local_gbd, run=True):
 
     if run:
         print("> Updating street network connectivity")
-        streets_initial = gpd.read_file(local_gbd.gpkg, layer='network_links')
-        streets = streets_initial.reset_index(drop=True)
-
-        nodes = gpd.GeoDataFrame(columns=['geometry'])
-        for i, mg in enumerate(streets.geometry):
-            if mg.__class__.__name__ == 'LineString': mg=[mg]
-            for ln in mg:
-                ni = i * 2
-                uid = lambda t: int("".join([str(o).replace('.', '') for o in list(t)]))
-                nodes.at[ni, 'osmid'] = uid(ln.coords[0])
-                nodes.at[ni, 'geometry'] = Point(ln.coords[0])
-                nodes.at[ni + 1, 'osmid'] = uid(ln.coords[1])
-                nodes.at[ni + 1, 'geometry'] = Point(ln.coords[1])
-                streets.at[i, 'osmid'] = int(i)
-                streets.at[i, 'from'] = uid(ln.coords[0])
-                streets.at[i, 'to'] = uid(ln.coords[1])
-                streets.at[i, 'geometry'] = ln
-
-        nodes = nodes.drop_duplicates(subset='osmid', ignore_index=True)
-        old_ids = nodes.osmid.unique()
-        new_ids = [i for i in range(len(old_ids))]
-        nodes = nodes.replace(old_ids, new_ids)
-        streets = streets.replace(old_ids, new_ids)
-
+        streets_initial = local_gbd.layers['network_links']
+        # Split multi-part lines into one row per part
+        streets = streets_initial.explode().reset_index(drop=True)
+        streets['osmid'] = np.arange(len(streets))
+
+        # Endpoints of every line (from0, to0, from1, to1, ...), nodes are identified by their exact coordinates
+        ends = np.array([ln.coords[i][:2] for ln in streets.geometry for i in [0, -1]]).reshape(-1, 2)
+        codes, uniques = pd.factorize(pd.MultiIndex.from_arrays([ends[:, 0], ends[:, 1]]))
+        codes = codes.reshape(-1, 2)
+        streets['from'] = codes[:, 0]
+        streets['to'] = codes[:, 1]
+
+        nodes = gpd.GeoDataFrame({'osmid': np.arange(len(uniques))}, geometry=gpd.points_from_xy(
+            uniques.get_level_values(0), uniques.get_level_values(1)))
         nodes.crs = local_gbd.crs
         streets.crs = local_gbd.crs
 
-        if len(streets_initial) < len(streets):
+        # Exploding only adds rows, fewer lines than initially means that lines were lost
+        if len(streets) < len(streets_initial):
             print("!!! Streets line count smaller than initial !!!")
 
-        nodes.to_file(local_gbd.gpkg, layer='network_intersections')
-        streets.to_file(local_gbd.gpkg, layer='network_links')
+        local_gbd.layers['network_intersections'] = nodes
+        local_gbd.layers['network_links'] = streets
 
     return local_gbd
 
-def estimate_emissions(gdf, title='', directory='/Volumes/Samsung_T5/Databases'):
-    # Iterate over each parcel to define the probability of dwellers to chose each mode
-    agents = pd.DataFrame()
-    for i in list(gdf.index):
-        if gdf.loc[i, 'population, 2016'] > 0:
-            for j in range(int(gdf.loc[i, 'population, 2016'])):
-                k = len(agents)
-                agents.at[k, 'parcel'] = i
-                agents.at[k, 'p_walk'] = gdf.loc[i, f'walk_{title}_n']
-                agents.at[k, 'p_bike'] = gdf.loc[i, f'bike_{title}_n']
-                agents.at[k, 'p_bus'] = gdf.loc[i, f'bus_{title}_n']
-                agents.at[k, 'p_drive'] = gdf.loc[i, f'drive_{title}_n']
-
-    # Randomly chose the mode of each agent based on the probabilities
-    print("> Assigning mode to each inhabitant")
-    for k in list(agents.index):
-        agents.at[k, 'mode'] = np.random.choice(
-            ['walk', 'bike', 'bus', 'drive'], 1, p=list(agents.loc[k, ['p_walk', 'p_bike', 'p_bus', 'p_drive']]))[0]
-
-    # Get number of people by mode choice by parcel
-    for p in list(gdf.index):
-        gdf.at[p, 'walkers'] = len(agents[(agents['mode'] == 'walk') & (agents['parcel'] == p)])
-        gdf.at[p, 'bikers'] = len(agents[(agents['mode'] == 'bike') & (agents['parcel'] == p)])
-        gdf.at[p, 'riders'] = len(agents[(agents['mode'] == 'bus') & (agents['parcel'] == p)])
-        gdf.at[p, 'drivers'] = len(agents[(agents['mode'] == 'drive') & (agents['parcel'] == p)])
+MODES = {'walk': 'walkers', 'bike': 'bikers', 'bus': 'riders', 'drive': 'drivers'}
+
 
+def draw_modes(gdf, title='', seed=None):
+    """
+    Draw the mode chosen by each inhabitant of every parcel at once, as one multinomial draw per parcel from the
+    probabilities of each mode
+
+    :param gdf: GeoDataFrame of parcels with 'population, 2016' and {mode}_{title}_n probabilities
+    :param title: (str) Suffix of the probability columns
+    :param seed: (int or SeedSequence) Seed of the random number generator, results are reproducible when defined
+    :return: DataFrame with the number of walkers, bikers, riders and drivers of each parcel
+    """
+    rng = np.random.default_rng(seed)
+    population = gdf['population, 2016'].fillna(0).clip(lower=0).astype(int).values
+    probabilities = gdf.loc[:, [f'{mode}_{title}_n' for mode in MODES.keys()]].astype(float).values
+    total = probabilities.sum(axis=1)
+    valid = np.isfinite(total) & (total > 0)
+    if (~valid & (population > 0)).any():
+        print(f"!!! Mode probabilities not defined for {(~valid & (population > 0)).sum()} populated parcels !!!")
+
+    counts = np.zeros((len(gdf), len(MODES)), dtype=int)
+    counts[valid] = rng.multinomial(population[valid], probabilities[valid] / total[valid, None])
+    return pd.DataFrame(counts, index=gdf.index, columns=list(MODES.values()))
+
+
+def emission_replicate(seed, gdf, title='', demand=5, bus_em=70, drive_em=120):
+    """
+    Draw the mode of each inhabitant and estimate the emissions of riders and drivers of each parcel
+
+    :param seed: (int or SeedSequence) Seed of the mode draw
+    :param gdf: DataFrame of parcels with population, mode probabilities and optionally a 'demand' column (km)
+    :param demand: (float) Trip length (km) of parcels without demand
+    :param bus_em: (float) Emissions of bus riders (g/km)
+    :param drive_em: (float) Emissions of drivers (g/km)
+    :return: DataFrame with mode counts and emissions of each parcel
+    """
+    df = draw_modes(gdf, title=title, seed=seed)
+    trip = gdf['demand'] if 'demand' in gdf.columns else demand
+    df['bus_em'] = bus_em * trip * df['riders']
+    df['drive_em'] = drive_em * trip * df['drivers']
+    df['total_em_kg_trip'] = (df['bus_em'] + df['drive_em'])/1000
+    df['total_em_kg_yr'] = df['total_em_kg_trip'] * 2 * 200
+    df['total_em_kg_yr_person'] = df['total_em_kg_yr']/gdf['population, 2016']
+    return df
+
+
+class StreamingSummary:
+    def __init__(self, percentiles=(5, 50, 95), bins=50, warmup=10):
+        """
+        Mean, standard deviation and percentiles of each cell of DataFrames produced by replicates, updated one
+        replicate at a time so that replicates are not kept in memory. Means and deviations are accumulated with
+        Welford's algorithm and percentiles are interpolated from fixed-bin histograms whose ranges are defined by the
+        first replicates.
+
+        :param percentiles: (tuple) Percentiles to estimate
+        :param bins: (int) Number of histogram bins of each cell
+        :param warmup: (int) Number of replicates kept to define the range of the histograms
+        """
+        self.percentiles = percentiles
+        self.bins = bins
+        self.warmup = warmup
+        self.replicates = 0
+        self.index = None
+        self.columns = None
+        self.buffer = []
+        self.edges = None
+        self.counts = None
+        return
+
+    def update(self, df):
+        """
+        Add one replicate, cells are matched by index and column labels and missing values are skipped
+        """
+        if self.index is None:
+            self.index, self.columns = df.index, df.columns
+            shape = (len(self.index), len(self.columns))
+            self.n = np.zeros(shape, dtype=int)
+            self.mean = np.zeros(shape)
+            self.m2 = np.zeros(shape)
+            self.min = np.full(shape, np.inf)
+            self.max = np.full(shape, -np.inf)
+        values = df.reindex(index=self.index, columns=self.columns).values.astype(float)
+        valid = np.isfinite(values)
+
+        self.n += valid
+        delta = np.where(valid, values - self.mean, 0)
+        self.mean += np.divide(delta, self.n, out=np.zeros_like(delta), where=self.n > 0)
+        self.m2 += np.where(valid, delta * (values - self.mean), 0)
+        self.min = np.where(valid, np.fmin(self.min, values), self.min)
+        self.max = np.where(valid, np.fmax(self.max, values), self.max)
+        self.replicates += 1
+
+        if self.edges is not None: self.bin(values)
+        else:
+            self.buffer.append(values)
+            if len(self.buffer) >= self.warmup: self.histogram()
+        return
+
+    def histogram(self):
+        """
+        Define the range of the histogram of each cell from the buffered replicates, widened by half of its span
+        """
+        lower = np.where(np.isfinite(self.min), self.min, 0)
+        upper = np.where(np.isfinite(self.max), self.max, 0)
+        span = np.where(upper > lower, upper - lower, np.maximum(np.abs(lower), 1))
+        self.edges = (lower - span / 2, (upper - lower + span) / self.bins)
+        self.counts = np.zeros(self.mean.shape + (self.bins,), dtype=np.int32)
+        for values in self.buffer: self.bin(values)
+        self.buffer = []
+        return
+
+    def bin(self, values):
+        lower, width = self.edges
+        rows, cols = np.nonzero(np.isfinite(values))
+        b = np.clip(np.floor((values[rows, cols] - lower[rows, cols]) / width[rows, cols]), 0, self.bins - 1)
+        self.counts[rows, cols, b.astype(int)] += 1
+        return
+
+    @property
+    def std(self):
+        return np.sqrt(np.divide(self.m2, self.n - 1, out=np.full(self.m2.shape, np.nan), where=self.n > 1))
+
+    def percentile(self, q):
+        """
+        Percentile of each cell, exact while fewer replicates than the warmup were summarized
+        """
+        if self.edges is None:
+            stack = np.stack(self.buffer)
+            with np.errstate(all='ignore'):
+                return np.nanpercentile(stack, q, axis=0) if np.isfinite(stack).any() else np.full(stack.shape[1:], np.nan)
+        lower, width = self.edges
+        cumulative = self.counts.cumsum(axis=2)
+        total = cumulative[..., -1]
+        target = total * q / 100
+        b = np.clip((cumulative < target[..., None]).sum(axis=2), 0, self.bins - 1)
+        before = np.where(b > 0, np.take_along_axis(cumulative, np.maximum(b - 1, 0)[..., None], axis=2)[..., 0], 0)
+        inside = np.take_along_axis(self.counts, b[..., None], axis=2)[..., 0]
+        fraction = np.divide(target - before, inside, out=np.zeros(target.shape), where=inside > 0)
+        value = np.clip(lower + (b + fraction) * width, self.min, self.max)
+        return np.where(total > 0, value, np.nan)
+
+    def frame(self):
+        """
+        Summary of the replicates, the mean of each column keeps its name and is followed by {column}_std and
+        {column}_p{percentile}
+        """
+        results = {}
+        mean = np.where(self.n > 0, self.mean, np.nan)
+        std = self.std
+        bands = {q: self.percentile(q) for q in self.percentiles}
+        for j, col in enumerate(self.columns):
+            results[col] = mean[:, j]
+            results[f"{col}_std"] = std[:, j]
+            for q, band in bands.items(): results[f"{col}_p{q}"] = band[:, j]
+        return pd.DataFrame(results, index=self.index)
+
+
+_SHARED = {}
+
+
+def _initialize(kwargs):
+    _SHARED.clear()
+    _SHARED.update(kwargs)
+    return
+
+
+def _replicate(function, seed):
+    return function(seed, **_SHARED)
+
+
+def replicate(function, seeds, seed=None, workers=None, summary=None, **kwargs):
+    """
+    Run replicates of a function across a pool of processes and summarize each one as soon as it is returned.
+    Replicates are summarized in the order they were submitted, so results are reproducible for the same seeds. Keyword
+    arguments are sent once to each worker and at most two replicates per worker are in flight, so memory does not grow
+    with the number of replicates.
+
+    :param function: Module-level function called as function(seed, **kwargs) that returns a DataFrame
+    :param seeds: (int or list) Number of replicates seeded from independent streams of one SeedSequence, or the seed
+    passed to each replicate
+    :param seed: (int) Entropy of the SeedSequence
+    :param workers: (int) Number of processes, the number of processors if None
+    :param summary: (StreamingSummary) Summary to update
+    :param kwargs: Keyword arguments shared by every replicate
+    :return: StreamingSummary
+    """
+    start_time = timeit.default_timer()
+    if isinstance(seeds, int): seeds = np.random.SeedSequence(seed).spawn(seeds)
+    if summary is None: summary = StreamingSummary()
+    if workers is None: workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initialize, initargs=(kwargs,)) as executor:
+        pending = deque()
+        for s in seeds:
+            if len(pending) >= 2 * workers: summary.update(pending.popleft().result())
+            pending.append(executor.submit(_replicate, function, s))
+        while len(pending) > 0: summary.update(pending.popleft().result())
+    elapsed = round((timeit.default_timer() - start_time) / 60, 1)
+    print(f"> {len(seeds)} replicates of {function.__name__} summarized in {elapsed} minutes")
+    return summary
+
+
+def replicate_emissions(gdf, title='', replicates=100, seed=None, workers=None, percentiles=(5, 50, 95)):
+    """
+    Mean, standard deviation and percentile bands of mode counts and emissions of each parcel from seeded replicates
+    of the mode draw (see emission_replicate)
+    """
+    columns = ['population, 2016'] + [f'{mode}_{title}_n' for mode in MODES.keys()] + \
+              (['demand'] if 'demand' in gdf.columns else [])
+    summary = replicate(emission_replicate, replicates, seed=seed, workers=workers,
+                        summary=StreamingSummary(percentiles=percentiles), gdf=pd.DataFrame(gdf.loc[:, columns]),
+                        title=title)
+    return summary.frame()
+
+
+def estimate_emissions(gdf, title='', directory='/Volumes/Samsung_T5/Databases', seed=None, replicates=1,
+                       workers=None):
+    """
+    Estimate travel demand, mode counts and emissions of each parcel
+
+    :param seed: (int) Seed of the mode draw, or entropy of the replicate seeds
+    :param replicates: (int) Number of seeded mode draws, more than one adds the standard deviation and percentile
+    bands of each column (see replicate_emissions)
+    :param workers: (int) Number of processes running the replicates
+    """
     # Load potential destinations
     print("> Estimating travel demand")
     crd_gdf = gpd.read_file(
@@ -239,15 +461,11 @@ def estimate_emissions(gdf, title='', directory='/Volumes/Samsung_T5/Databases')
     #     gdf.at[p, 'demand'] = (sum(ls)/len(ls))/1000
     gdf['demand'] = 5
 
-    # Estimate emissions for riders and drivers
-    print("> Calculating potential emissions")
-    bus_em = 70
-    drive_em = 120
-    gdf['bus_em'] = bus_em * gdf['demand'] * gdf['riders']
-    gdf['drive_em'] = drive_em * gdf['demand'] * gdf['drivers']
-    gdf['total_em_kg_trip'] = (gdf['bus_em'] + gdf['drive_em'])/1000
-    gdf['total_em_kg_yr'] = gdf['total_em_kg_trip'] * 2 * 200
-    gdf['total_em_kg_yr_person'] = gdf['total_em_kg_yr']/gdf['population, 2016']
+    # Randomly chose the mode of each inhabitant and estimate emissions for riders and drivers
+    print("> Assigning mode to each inhabitant and calculating potential emissions")
+    if replicates > 1: estimate = replicate_emissions(gdf, title=title, replicates=replicates, seed=seed, workers=workers)
+    else: estimate = emission_replicate(seed, gdf, title=title)
+    for col in estimate.columns: gdf[col] = estimate[col]
 
     return gdf
 
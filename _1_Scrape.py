@@ -1,3 +1,4 @@
+from Download import DownloadManager
 from Geospatial.Scraper import BritishColumbia, Canada
 from _0_Variables import regions
 
@@ -21,9 +22,9 @@ for key, value in regions.items():
         inventory_dir=f'{bca_dir}170811_BCA_Provincial_Data/Inventory Information - RY 2017.csv',
         geodatabase_dir=f'{bca_dir}Juchan_backup/BCA_2017_roll_number_method/BCA_2017_roll_number_method.gdb')
 
-    # BC Transit
-    bc.get_bc_transit(run=True, down=False, urls=[
-        #'http://victoria.mapstrat.com/current/google_transit.zip',
-        'local', 'local'
-        #'https://www.bctransit.com/data/gtfs/prince-george.zip'
-    ])
+    # BC Transit, GTFS feeds are downloaded in parallel and skipped if they did not change since the last download
+    feeds = DownloadManager(directory='/Volumes/Samsung_T5/Databases/Transit').download_all([
+        'http://victoria.mapstrat.com/current/google_transit.zip',
+        'https://www.bctransit.com/data/gtfs/prince-george.zip'
+    ], workers=4)
+    bc.get_bc_transit(run=True, down=False, urls=feeds)
@@ -1,9 +1,8 @@
 import gc
 
-import geopandas as gpd
 from Analyst import GeoBoundary
 from Geospatial.Scraper import BritishColumbia, Canada
-from Sandbox import proxy_indicators, proxy_network
+from Sandbox import proxy_district, proxy_indicators, proxy_network
 from _0_Variables import regions, radius, network_layers, network_bike, network_bus
 
 
@@ -59,18 +58,25 @@ for sandbox, value in experiments.items():
 
     # Transfer network indicators to sandbox
     proxy = proxy_network(proxy)
-    proxy.nodes = gpd.read_file(proxy.gpkg, layer='network_intersections')
-    proxy.links = gpd.read_file(proxy.gpkg, layer='network_links')
+    proxy.nodes = proxy.layers['network_intersections']
+    proxy.links = proxy.layers['network_links']
 
     # Extract elevation data
     proxy.node_elevation()
 
+    # District-wide layers are transferred once, the stage is cached until its inputs change
+    district = GeoBoundary(experiments[sandbox][0], crs=26910)
+    proxy_district(proxy, district)
+
+    # Experiments are stored as deltas of the first one and materialized when read
+    for name in ['land_parcels', 'fabric_buildings']:
+        proxy.layers.scenarios(name, baseline=list(experiments[sandbox][1].keys())[0]).migrate()
+
     for code, year in experiments[sandbox][1].items():
-        district = GeoBoundary(experiments[sandbox][0], crs=26910)
 
         # Calculate spatial indicators
         proxy = proxy_indicators(proxy, district, experiment={code: year})
-        p_gdf = gpd.read_file(proxy.gpkg, layer=f'land_parcels_{code}')
+        p_gdf = proxy.layers[f'land_parcels_{code}']
 
         # Perform network analysis
         network_analysis = proxy.network_analysis(
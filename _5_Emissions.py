@@ -1,12 +1,14 @@
 import geopandas as gpd
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.font_manager as fm
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from Analyst import GeoBoundary
+from Analyst import GeoBoundary, area_weighted, overlap_matrix
 from geopy.distance import distance
 from matplotlib import rc
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+from Maps import Maps
+from Results import ResultsCube
 pd.set_option('display.width', 700)
 
 fm.fontManager.ttflist += fm.createFontList(['/Volumes/Samsung_T5/Fonts/roboto/Roboto-Light.ttf'])
@@ -21,26 +23,36 @@ exp_df = pd.DataFrame()
 macc = pd.DataFrame()
 tf_years = 20
 
-for infra, values in {'bus': 'Frequent transit', 'bike': 'Cycling lanes'}.items():
+# Mode shares of every experiment, random seed and infrastructure on the grid (see _3_ModeShifts)
+if not ResultsCube.is_complete(f'{directory}/Results/Mode Shares'):
+    raise RuntimeError("Mode shares results cube is not complete, run _3_ModeShifts first")
+cube = ResultsCube(f'{directory}/Results/Mode Shares')
+proxy = GeoBoundary('Hillside Quadra Sandbox', crs=26910, directory=directory)
+blocks_raw = gpd.read_file(f"{directory}/UrbanBlocks.shp")
+blocks_raw.crs = 26910
+blocks_raw = blocks_raw.reset_index(drop=True)
+grid_blocks = overlap_matrix(cube.geometry, blocks_raw, directory=f'{directory}/Cache')
 
-    # Calculate differences from E0
-    proxy_files = {
-        'E0': gpd.read_file(f'{directory}/{name} Sandbox_mob_{infra}_e0_na.geojson_{infra}_s0.geojson'),
-        'E1': gpd.read_file(f'{directory}/{name} Sandbox_mob_{infra}_e1_na.geojson_{infra}_s0.geojson'),
-        'E2': gpd.read_file(f'{directory}/{name} Sandbox_mob_{infra}_e2_na.geojson_{infra}_s0.geojson'),
-        'E3': gpd.read_file(f'{directory}/{name} Sandbox_mob_{infra}_e3_na.geojson_{infra}_s0.geojson'),
-    }
+# Block map panels are drawn once and updated for each infrastructure scenario
+maps = Maps(blocks_raw, nrows=len(em_modes), ncols=len(experiments), figsize=(15, 10), colorbar='row',
+            label='Emissions (tCO2/person/year)')
 
-    # Load blocks layer
-    blocks_gdf = gpd.read_file(f'{directory}/Mode Shifts - {infra.title()} - Urban Blocks.geojson')
-    blocks_gdf.crs = 26910
+for infra, values in {'bus': 'Frequent transit', 'bike': 'Cycling lanes'}.items():
 
-    # Spatial join from parcels to grid
-    proxy = GeoBoundary('Hillside Quadra Sandbox', crs=26910, directory=directory)
+    # Average mode shares and shifts from E0 across seeds and aggregate them from grid to blocks
+    shares = cube.mean('seed', infra=infra)
+    shifts = np.nanmean(cube.delta('E0', infra=infra), axis=1)
+    columns = {}
+    for e, exp in enumerate(cube.labels['experiment']):
+        for m, mode in enumerate(cube.labels['mode']):
+            columns[f"{mode}_{exp.lower()}_rf_n"] = shares[e, m]
+            columns[f"d_{exp.lower()}_{mode}"] = shifts[e, m]
+    blocks_gdf = gpd.GeoDataFrame(pd.concat([blocks_raw, area_weighted(grid_blocks, pd.DataFrame(columns))], axis=1),
+                                  geometry='geometry', crs=26910)
 
     print("Joining resident counts from parcels to blocks")
     for exp in experiments:
-        gdf = proxy_files[exp.title()]
+        gdf = proxy.layers[f'land_parcels_{exp}']
         gdf.columns = [col.lower() for col in gdf.columns]
         gdf[f'population_{exp}'] = gdf['population, 2016']
         blocks_gdf['block_id'] = blocks_gdf.index
@@ -86,7 +98,7 @@ for infra, values in {'bus': 'Frequent transit', 'bike': 'Cycling lanes'}.items(
 
         for i, exp in enumerate(experiments):
             # Get destinations within the sandbox
-            parcel_gdf = gpd.read_file(proxy.gpkg, layer=f'land_parcels_{exp.lower()}')
+            parcel_gdf = proxy.layers[f'land_parcels_{exp.lower()}']
             sb_dst = parcel_gdf[(parcel_gdf['Landuse'] == 'CM') | (parcel_gdf['Landuse'] == 'MX')].to_crs(4326)
             final_dst = pd.concat([d_gdf_4326, sb_dst])
 
@@ -178,10 +190,10 @@ for infra, values in {'bus': 'Frequent transit', 'bike': 'Cycling lanes'}.items(
 
     # Get average length of routes that crosses the neighbourhood
     region = GeoBoundary('Capital Regional District, British Columbia')
-    routes = gpd.read_file(region.gpkg, layer='network_routes')
+    routes = region.layers['network_routes']
 
     # Get routes that intersect with sandbox
-    boundary = gpd.read_file(local_gbd.gpkg, layer='land_municipal_boundary')
+    boundary = local_gbd.layers['land_municipal_boundary']
     routes_overlay = gpd.overlay(routes, boundary)
     routes_overlay['length'] = [geom.length for geom in routes_overlay['geometry']]
 
@@ -195,8 +207,8 @@ for infra, values in {'bus': 'Frequent transit', 'bike': 'Cycling lanes'}.items(
     cost = total_cost - total_revenue
     cost_per_trip = (cost/total_trips) * ave_ratio_route_in_boundary
 
-    links = gpd.read_file(local_gbd.gpkg, layer='network_links')
-    stops = gpd.read_file(local_gbd.gpkg, layer='network_stops')
+    links = local_gbd.layers['network_links']
+    stops = local_gbd.layers['network_stops']
     for i, exp in enumerate(experiments):
         if exp == 'e0':
             yr = 2020
@@ -213,50 +225,21 @@ for infra, values in {'bus': 'Frequent transit', 'bike': 'Cycling lanes'}.items(
     exp_df[f"{infra}_infra_cost"] = infra_cost
     exp_df[f"{infra}_infra_cost_per_cap"] = exp_df[f"{infra}_infra_cost"] / exp_df["pop"]
 
-    # Plot results
-    fig_size = (15, 10)
-    fig1 = plt.figure(constrained_layout=False, figsize=fig_size)
-    ax1 = {}
-    main = 12
-    widths = [main, main, main, main, 1]
-    heights = [main, main, main]
-    gs = fig1.add_gridspec(nrows=len(em_modes), ncols=len(experiments)+1, width_ratios=widths, height_ratios=heights)
-
+    # Plot block maps with emissions per each mode per capita, values of blocks with missing data are not drawn
+    blocks_valid = blocks_gdf.set_index('block_id')
+    blocks_valid = blocks_valid.where(blocks_valid.notna().all(axis=1)).reindex(blocks_raw.index)
     for i, (mode, cmap) in enumerate(zip(em_modes, ['Reds', 'Blues', 'viridis_r'])):
-        ax1[i] = {}
+        cols = [f'{e}_{mode}_em_pc' for e in experiments]
+        vmin = min(blocks_valid.loc[:, cols].min())
+        vmax = max(blocks_valid.loc[:, cols].max())
         for j, exp in enumerate(experiments):
-            print(f"\nPlotting results on {exp}(i: {i}) for {mode}(j: {j})")
-
-            # Create non-NaN GeoDataFrame
-            blocks_valid = blocks_gdf.dropna()
-
-            # Calculate mean and median
             mean = blocks_valid[f'{exp}_{mode}_em_pc'].mean()
-
-            # Get minimum and maximum values on each experiment
-            cols = [f'{e}_{mode}_em_pc' for e in experiments]
-            vmin = min(blocks_valid.loc[:, cols].min())
-            vmax = max(blocks_valid.loc[:, cols].max())
-            print(f"{cols} min: {vmin}, max: {vmax}, mean: {mean}")
-
-            # Plot block maps with emissions per each mode per capita
-            ax1[i][j] = fig1.add_subplot(gs[i, j])
-            blocks_valid.plot(f"{exp}_{mode}_em_pc", ax=ax1[i][j], legend=False, vmin=vmin, vmax=vmax, cmap=cmap)
-            ax1[i][j].set_title(f"{exp.upper()}, {mode.upper()} | MEAN: {round(mean/1000, 2)} tCO2/p/y")
-            ax1[i][j].set_axis_off()
-
-            if j == len(experiments) - 1:
-                ax1[i][j + 1] = fig1.add_subplot(gs[i, j + 1])
-                divider = make_axes_locatable(ax1[i][j + 1])
-                leg_ax = divider.append_axes(position="bottom", size="100%", pad="0%", add_to_figure=False)
-                array = np.arange(vmin, vmax)
-                show = leg_ax.imshow([array], cmap=cmap, aspect='auto')
-                cb = fig1.colorbar(show, cax=ax1[i][j + 1], orientation="vertical")
-                cb.set_label('Emissions (tCO2/person/year)')
+            print(f"{exp} {mode} min: {vmin}, max: {vmax}, mean: {mean}")
+            maps.panel(i, j, blocks_valid[f'{exp}_{mode}_em_pc'].values, cmap=cmap, vmin=vmin, vmax=vmax,
+                       title=f"{exp.upper()}, {mode.upper()} | MEAN: {round(mean/1000, 2)} tCO2/p/y")
 
     # Export plots and maps to files
-    plt.tight_layout()
-    fig1.savefig(f'{directory}/Mode Shifts - Emissions per Capita - {infra}.png')
+    maps.save(f'{directory}/Mode Shifts - Emissions per Capita - {infra}.png')
 
     # Export data on MACC DataFrame
     for i, exp in enumerate(experiments):
@@ -272,4 +255,5 @@ for infra, values in {'bus': 'Frequent transit', 'bike': 'Cycling lanes'}.items(
 print(macc)
 print("Exporting MACC to excel")
 macc.to_excel(f'{directory}/Mobility MACC.xlsx')
+maps.close()
 print(f"End")